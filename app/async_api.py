@@ -0,0 +1,151 @@
+import sys
+import sqlite3
+from aiohttp import web
+from client_mgt import ClientMgt
+from share_mgt import ShareMgt
+from event_mgt import EventMgt, decode_json, sync_batch_max_events
+from async_db import AsyncDb
+from conf import *
+
+# Machine facing endpoints (agents and start.py) served by one asyncio
+# process, side by side with the uwsgi UI app: a slow UI page never holds
+# back sync reporting and idle agent connections cost no worker.
+# nginx routes these paths here when ASYNC_API is enabled, responses are
+# the same as the Flask routes in unicloud.py. The UI app owns the schema,
+# it creates and migrates the database.
+
+root_dir     = "/data"
+authkeyfile  = root_dir + "/.ssh/unicloud_authorized_keys"
+api_socket   = "/usr/local/unicloud/unicloud-api.sock"
+
+routes = web.RouteTableDef()
+
+def text(body, status=200):
+    return web.Response(text=body, status=status, content_type='text/html')
+
+@routes.get('/status')
+async def status(request):
+    return text("[OK] Ready to serve sir..\n")
+
+@routes.get('/clients/status/{client}')
+async def client_status(request):
+    client = request.match_info['client']
+    cl = ClientMgt(client)
+    if (await request.app['db'].read(cl.exist))[0] == 0:
+      return text("Client %s does not exist, register first\n" % client, 404)
+    status = await request.app['db'].read(cl.status)
+    if status[0][1] == "OK":
+      return text("Client %s status: [ %s ]\n" % (status[0][0], status[0][1]))
+    else:
+      return text("Client %s need to be activated. Activate from server UI!" % status[0][0], 401)
+
+@routes.post('/clients/register')
+async def client_register(request):
+    form = await request.post()
+    name = form.get('name')
+    ssh_key = form.get('ssh_key')
+    share = form.get('share')
+    if name is not None and ssh_key is not None:
+       client = ClientMgt(name)
+       if (await request.app['db'].read(client.exist))[0] > 0:
+           return web.json_response("Error Client %s already exist" % name, status=500)
+       # registrations are rare, add commits on its own connection
+       await request.app['db'].read(client.add, ssh_key, authkeyfile, "join", share)
+       return web.json_response("Client %s added successfully, Activate it from server UI!" % name)
+    return web.json_response("Incomplete request", status=500)
+
+@routes.get('/shares/info/{name}')
+async def share_info(request):
+    name = request.match_info['name']
+    result = await request.app['db'].read(ShareMgt(name).info, "all")
+    if not result:
+      return text("Error, %s does not exist\n" % name, 404)
+    return web.json_response(result)
+
+@routes.get('/shares/info/{name}/path')
+async def share_info_path(request):
+    name = request.match_info['name']
+    result = await request.app['db'].read(ShareMgt(name).info, "path")
+    if not result:
+      return text("Error, %s does not exist\n" % name, 404)
+    return text(result + "\n")
+
+async def sync_values(request):
+    """ /sync/start and /sync/end fields, from a form or a JSON body, None if the JSON is not valid """
+    if request.content_type == 'application/json':
+      # aiohttp already inflated a gzip or deflate body
+      values = decode_json(await request.read())
+      return values if isinstance(values, dict) else None
+    return await request.post()
+
+@routes.route('*', '/sync/start/{client}')
+async def sync_start(request):
+    client = request.match_info['client']
+    form = await sync_values(request)
+    if form is None:
+      return text("Expected a JSON object", 400)
+    share = form.get('share')
+    start_ts = int(form.get('start_ts'))
+    clientmgt = ClientMgt(client)
+    if (await request.app['db'].read(clientmgt.exist))[0] == 0:
+      return text("Client %s does not exist, register first" % client, 500)
+    status = "SYNCING"
+    await request.app['db'].write(clientmgt.sync_start, start_ts, share)
+    return text("Sync Started, record updated with status %s" % status)
+
+@routes.route('*', '/sync/end/{client}')
+async def sync_end(request):
+    client = request.match_info['client']
+    form = await sync_values(request)
+    if form is None:
+      return text("Expected a JSON object", 400)
+    start_ts = int(form.get('start_ts'))
+    status = form.get('status')
+    end_ts = int(form.get('end_ts'))
+    clientmgt = ClientMgt(client)
+    if (await request.app['db'].read(clientmgt.exist))[0] == 0:
+      return text("Client %s does not exist, register first" % client, 500)
+    try:
+      metrics = EventMgt.parse_metrics(form)
+    except ValueError:
+      return text("Sync metrics must be integers", 400)
+    await request.app['db'].write(EventMgt().end, client, start_ts, status, form.get('sync_status'), end_ts, form.get('log'), metrics)
+    response = text("Sync Terminated, record updated with status %s, duration %d" % (status, end_ts - start_ts), 201)
+    hint = await request.app['db'].read(clientmgt.sync_hint, sync_interval_hint)
+    if hint is not None:
+      response.headers['X-Sync-Interval'] = str(hint)
+    return response
+
+@routes.route('*', '/sync/batch/{client}')
+async def sync_batch(request):
+    client = request.match_info['client']
+    # aiohttp already inflated a gzip or deflate body, client_max_size bounds it
+    events = decode_json(await request.read())
+    if not isinstance(events, list) or len(events) > sync_batch_max_events:
+      return web.json_response("Expected a JSON array of at most %d events" % sync_batch_max_events, status=400)
+    clientmgt = ClientMgt(client)
+    if (await request.app['db'].read(clientmgt.exist))[0] == 0:
+      return web.json_response("Client %s does not exist, register first" % client, status=500)
+    try:
+      # the agent drops its spooled events on success, never acknowledge before the commit
+      recorded = await request.app['db'].write(EventMgt().record, client, events, wait=True)
+    except (KeyError, TypeError, ValueError, OverflowError, sqlite3.IntegrityError) as e:
+      return web.json_response("Bad event in batch: %s" % e, status=400)
+    return web.json_response({'recorded': recorded}, status=201)
+
+async def close_db(app):
+    app['db'].close()
+
+def create_app():
+    app = web.Application(client_max_size=32 * 1024 * 1024)
+    app['db'] = AsyncDb(sync_write_mode)
+    app.add_routes(routes)
+    app.on_cleanup.append(close_db)
+    return app
+
+if __name__ == '__main__':
+    # python3 async_api.py [port], the unix socket nginx proxies to by default
+    if len(sys.argv) > 1:
+        web.run_app(create_app(), port=int(sys.argv[1]))
+    else:
+        web.run_app(create_app(), path=api_socket)
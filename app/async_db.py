@@ -0,0 +1,49 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from write_queue import WriteQueue
+
+# asyncio access to the database for async_api: the sqlite3 calls of the
+# Mgt classes run in a small thread pool, each thread with its own
+# connection (db_conn), and writes go through the group commit queue, so
+# the event loop never blocks on sqlite and thousands of pending requests
+# cost a few threads.
+
+read_workers = 4
+
+class AsyncDb(object):
+    def __init__(self, write_mode='group', workers=read_workers):
+        self.readers = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='db-read')
+        # direct writes would run in the event loop thread, use the single thread writer instead
+        self.write_queue = WriteQueue('group' if write_mode == 'direct' else write_mode)
+
+    async def read(self, fn, *args):
+        """ fn(*args) in a reader thread """
+        return await asyncio.get_running_loop().run_in_executor(self.readers, fn, *args)
+
+    async def write(self, fn, *args, wait=None):
+        """ fn(*args, commit=False) in the next write group
+        :param wait: wait for the commit, default is the write mode (no wait in async mode)
+        :return: what fn returned, None when not waiting
+        """
+        op = self.write_queue.submit(fn, *args)
+        if wait is None:
+            wait = self.write_queue.mode != 'async'
+        if not wait:
+            return None
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        op.add_done_callback(lambda op: loop.call_soon_threadsafe(self.resolve, future, op))
+        return await future
+
+    @staticmethod
+    def resolve(future, op):
+        if future.cancelled():
+            return
+        if op.error is not None:
+            future.set_exception(op.error)
+        else:
+            future.set_result(op.result)
+
+    def close(self):
+        self.write_queue.flush()
+        self.readers.shutdown()
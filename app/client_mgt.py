@@ -1,5 +1,10 @@
 import time
-from db_conn import get_db, query_db
+from collections import namedtuple
+from db_conn import get_db, query_db, modify_db
+from event_mgt import EventMgt, compress_log
+
+ClientInfo = namedtuple('ClientInfo', ['name', 'share', 'ok', 'ko', 'total', 'lastseen', 'joindate', 'status',
+                                       'ssh_key', 'threshold', 'avg_duration', 'sync_status'])
 
 class ClientMgt(object):
     client = ""
@@ -7,51 +12,62 @@ class ClientMgt(object):
         self.client = client
 
     def lastseen(self):
-        query = "select end_ts from events where client='%s' order by end_ts limit 1;" % self.client
-        result = query_db(query)
+        query = "select end_ts from events where client=? order by end_ts limit 1;"
+        result = query_db(query, (self.client,))
         return result
 
-    def info(self):
-        result = {}
-        query = "select count(status) from events where client='%s' and status='OK';" %self.client
-        count_ok=query_db(query)[0]
-        query = "select count(status) from events where client='%s' and status='KO';" %self.client
-        count_ko = query_db(query)[0]
-        #count_total = count_ok + count_ko
-        query = "select end_ts from events where client='%s' order by id desc limit 1;" %self.client
-        lastseen = query_db(query)
-        query = "select joindate from clients where name='%s';" % self.client
-        joindate = query_db(query)
-        query = "select status from clients where name='%s';" % self.client
-        status = query_db(query)
-        query = "select ssh_key from clients where name='%s';" % self.client
-        ssh_key = query_db(query)
-        query = "select share from clients where name='%s';" % self.client
-        share = query_db(query)
-        query = "select threshold from clients where name='%s';" % self.client
-        threshold = query_db(query)
-        #print ("last seen: %s" % lastseen)
-        query = "select avg(duration) from events where client='%s';" % self.client
-        avg_duration = query_db(query)
-        if lastseen == []:
-            result.update({'share': share[0][0], 'ok': count_ok[0], 'ko': count_ko[0], 'total': count_ok[0]+count_ko[0],
-                           'lastseen': 'Never', 'joindate': joindate[0][0], 'status': status[0][0], 'ssh_key': ssh_key[0][0],
-                           'threshold': threshold[0][0], 'avg_duration': "None" })
+    def summary(self):
+        """ client row and its events summary, raw and rolled up, in a single query
+        :return: ClientInfo or None if the client does not exist
+        """
+        query = """ select clients.name,
+                      clients.share,
+                      ifnull(ev.ok, 0),
+                      ifnull(ev.ko, 0),
+                      ifnull(ev.ok, 0) + ifnull(ev.ko, 0),
+                      case when ev.client is null then 'Never'
+                           else ifnull((select end_ts from events where client = clients.name order by id desc limit 1),
+                                       (select max(period_ts) from events_rollup where client = clients.name)) end,
+                      clients.joindate,
+                      clients.status,
+                      clients.ssh_key,
+                      clients.threshold,
+                      ev.avg_duration,
+                      clients.sync_status
+                    from clients
+                    left join (select client,
+                                 sum(ok) as ok,
+                                 sum(ko) as ko,
+                                 sum(duration_sum) * 1.0 / sum(duration_count) as avg_duration
+                               from (select client, sum(status = 'OK') as ok, sum(status = 'KO') as ko,
+                                       sum(duration) as duration_sum, count(duration) as duration_count
+                                     from events where client = ? group by client
+                                     union all
+                                     select client, sum(ok), sum(ko), sum(duration_sum), sum(duration_count)
+                                     from events_rollup where client = ? group by client)
+                               group by client) ev on ev.client = clients.name
+                    where clients.name = ? """
+        row = query_db(query, (self.client, self.client, self.client), one=True)
+        if row is None:
+            return None
+        info = ClientInfo(*row)
+        if info.avg_duration is None:
+            info = info._replace(avg_duration="None")
         else:
-            result.update({'share': share[0][0], 'ok': count_ok[0], 'ko': count_ko[0], 'total': count_ok[0]+count_ko[0],
-                           'lastseen': lastseen[0][0], 'joindate': joindate[0][0], 'status': status[0][0], 'ssh_key': ssh_key[0][0],
-                           'threshold': threshold[0][0], 'avg_duration': float("{0:.2f}".format(avg_duration[0][0]))})
-        return result
+            info = info._replace(avg_duration=float("{0:.2f}".format(info.avg_duration)))
+        return info
 
+    def info(self):
+        return self.summary()._asdict()
 
     def status(self):
-        query = "select name,status from clients where name='%s'" % self.client
-        result = query_db(query)
+        query = "select name,status from clients where name=?"
+        result = query_db(query, (self.client,))
         return result
 
     def exist(self):
-        query = "select count(name) from clients where name='%s'" % self.client
-        result = query_db(query)
+        query = "select count(name) from clients where name=?"
+        result = query_db(query, (self.client,))
         return result[0]
 
     def add(self, ssh_key, authkeyfile, register_type, share):
@@ -75,10 +91,9 @@ class ClientMgt(object):
            status = "Active"
         else:
            status = "Registered"
-        query = "insert into clients (name,ssh_key,status,joindate,share,threshold) values ('%s','%s','%s',%d,'%s',0)" % (self.client, ssh_key, status, int(time.time()), share)
+        query = "insert into clients (name,ssh_key,status,joindate,share,threshold) values (?,?,?,?,?,0)"
         #print (query)
-        query_db(query)
-        get_db().commit()
+        modify_db(query, (self.client, ssh_key, status, int(time.time()), share))
         return "<br>Client %s added to DB, status %s" % ( self.client, status )
     
     def add_to_keyfile(self, authkeyfile, ssh_key):
@@ -94,9 +109,8 @@ class ClientMgt(object):
         self.ssh_key = ssh_key
         self.authkeyfile = authkeyfile
         result=[]
-        query = ("update clients set status='Active' where name='%s'") % self.client
-        query_db(query)
-        get_db().commit()
+        query = "update clients set status='Active' where name=?"
+        modify_db(query, (self.client,))
         result = [ "<br>Client activated on database" ]
         result.append(self.add_to_keyfile(self.authkeyfile, self.ssh_key))
         return result
@@ -104,62 +118,69 @@ class ClientMgt(object):
     def set_threshold(self, threshold):
         self.threshold = threshold
         #print (threshold)
-        query = ("update clients set threshold=%d where name='%s'") % (self.threshold, self.client)
-        query_db(query)
-        get_db().commit()
+        query = "update clients set threshold=? where name=?"
+        modify_db(query, (self.threshold, self.client))
         return "<br>Client %s threshold set to %d seconds" % (self.client, int(threshold))
 
-    def sync_status(self, type='db'):
-        self.type = type
-        if self.type == "db":
-            query = "select sync_status from clients where name='%s';" % self.client
-            status = query_db(query)
-            return status[0][0]
-        else:
-           query = "select threshold from clients where name='%s';" % self.client
-           threshold = query_db(query)
-           query = "select max(id),end_ts from events where client='%s' and status='OK';" % self.client
-           lastok = query_db(query)
-           if lastok[0][0]:
-              ts = int(time.time())
-              delta = ts - lastok[0][1]
-              if delta <= threshold[0][0]:
-                return "In Sync"
-              else:
-                return "Out of Sync"
-           else:
-              return "Never synced"
-
-           #print ("Delta is %d, Lastok: %d, Threshold is %d," % ( delta, lastok[0][0], threshold[0][0] ))
-           #print ("LastOk %d" % lastok[0][0])
-           #print ("Threshold %d" % threshold[0][0])
-
-
-    def update_sync_status(self, s_status):
-        #print(self.client)
-        self.s_status = s_status
-        current_status = self.sync_status()
-        #print(current_status)
-        if current_status != s_status:
-           query = ("update clients set sync_status='%s' where name='%s'") % (self.s_status, self.client)
-           #print(query)
-           query_db(query)
-           get_db().commit()
-
-    def check_pending(self):
-        query="select * from events where client='%s' and status='SYNCING';" % self.client
-        brokensync=query_db(query)
+    def sync_status(self):
+        query = "select sync_status from clients where name=?;"
+        status = query_db(query, (self.client,))
+        return status[0][0]
+
+    def refresh_sync_status(self, now):
+        """ recompute sync_status of every client with a threshold
+        in one update, the last OK event is looked up per client on
+        the (client, status, id) index, once compacted in the rollup
+        table (start of its period, a lower bound)
+        :param now: reference timestamp
+        :return: number of clients updated
+        """
+        query = """ update clients set sync_status =
+                      case ? - ifnull((select end_ts from events
+                                       where client = clients.name and status = 'OK'
+                                       order by id desc limit 1),
+                                      (select max(period_ts) from events_rollup
+                                       where client = clients.name and ok > 0)) <= threshold
+                        when 1 then 'In Sync'
+                        when 0 then 'Out of Sync'
+                        else 'Never synced'
+                      end
+                    where threshold != 0 """
+        return modify_db(query, (now,))
+
+    def check_pending(self, commit=True):
+        query="select id from events where client=? and status='SYNCING';"
+        brokensync=query_db(query, (self.client,))
         #print("Brokensync :%s" % brokensync)
         if brokensync != []:
-           query="update events set status='KO', log='Sync was interrupted' where client='%s' and status='SYNCING';" % self.client
-           query_db(query)
-           get_db().commit()
+           query="insert or replace into event_logs (event_id, log) select id, ? from events where client=? and status='SYNCING';"
+           modify_db(query, (compress_log('Sync was interrupted'), self.client), commit=False)
+           query="update events set status='KO' where client=? and status='SYNCING';"
+           modify_db(query, (self.client,), commit)
+
+    def sync_hint(self, max_interval=0):
+        """ longest the client should wait before its next sync, sent back as X-Sync-Interval
+        :param max_interval: server wide limit, 0 for none
+        :return: seconds, None to leave it to the client
+        """
+        hints = [int(max_interval)] if int(max_interval) > 0 else []
+        row = query_db("select threshold from clients where name=?", (self.client,), one=True)
+        if row is not None and row[0]:
+            # at least two syncs per threshold, so a single slow sync does not flag it Out of Sync
+            hints.append(max(1, int(row[0]) // 2))
+        return min(hints) if hints else None
+
+    def sync_start(self, start_ts, share, commit=True):
+        """ close the syncs left SYNCING and open a new one, a retried start of the same sync is a no-op """
+        if query_db("select 1 from events where client=? and start_ts=?", (self.client, start_ts), one=True) is not None:
+            return 0
+        self.check_pending(commit=False)
+        return EventMgt().start(self.client, start_ts, share, commit)
 
     def remove(self, authkeyfile):
         self.authkeyfile = authkeyfile
-        query = "delete from clients where name = '%s'" % self.client
-        query_db(query)
-        get_db().commit()
+        query = "delete from clients where name = ?"
+        modify_db(query, (self.client,))
         with open(authkeyfile, "r+") as f:
             new_f = f.readlines()
             f.seek(0)
@@ -1,19 +1,58 @@
+import os
 import sqlite3
-from flask import Flask, g
+import threading
 
 root_dir = "/data"
 database = root_dir + "/unicloud.db"
 
+# One long lived connection per worker process and thread, WAL lets the
+# readers run while a sync endpoint is writing.
+pragmas = [
+    "pragma journal_mode = WAL",
+    "pragma synchronous = NORMAL",
+    "pragma mmap_size = 268435456",
+    "pragma cache_size = -16000",
+    "pragma temp_store = MEMORY",
+]
+busy_timeout = 10
+cached_statements = 256
+
+_local = threading.local()
+
+def connect(db_file=database):
+    conn = sqlite3.connect(db_file, timeout=busy_timeout, cached_statements=cached_statements)
+    for pragma in pragmas:
+        conn.execute(pragma)
+    return conn
+
 def get_db():
-    db = getattr(g, '_database', None)
-    if db is None:
-        db = g._database = sqlite3.connect(database)
-        #db.row_factory = sqlite3.Row
+    db = getattr(_local, 'database', None)
+    # uwsgi forks workers after import, never share a connection across processes
+    if db is None or _local.pid != os.getpid():
+        db = _local.database = connect()
+        _local.pid = os.getpid()
     return db
 
+def release_db():
+    """ rollback whatever a request left uncommitted, the connection stays open """
+    db = getattr(_local, 'database', None)
+    if db is not None and _local.pid == os.getpid() and db.in_transaction:
+        db.rollback()
+
+# Every statement goes through query_db/modify_db with bound parameters:
+# the sql text stays constant, so sqlite3 reuses the prepared statement
+# from the connection cache instead of parsing and planning it again.
+
 def query_db(query, args = (), one = False):
     cur = get_db().execute(query, args)
     rv = cur.fetchall()
     cur.close()
     return (rv[0] if rv else None) if one else rv
 
+def modify_db(query, args = (), commit = True):
+    cur = get_db().execute(query, args)
+    rowcount = cur.rowcount
+    cur.close()
+    if commit:
+        get_db().commit()
+    return rowcount
@@ -0,0 +1,244 @@
+from sqlite3 import Error
+from event_mgt import compress_log
+
+
+def reconcile_stats(conn):
+    """ recount the stats row from the source tables
+    :param conn: Connection object
+    """
+    conn.execute(""" update stats set
+                       nevents = (select count(id) from events)
+                                 + (select ifnull(sum(total), 0) from events_rollup),
+                       nevents_ok = (select count(id) from events where status='OK')
+                                    + (select ifnull(sum(ok), 0) from events_rollup),
+                       nevents_ko = (select count(id) from events where status='KO')
+                                    + (select ifnull(sum(ko), 0) from events_rollup),
+                       nclients = (select count(id) from clients),
+                       nshares = (select count(id) from shares),
+                       toregister = (select count(id) from clients where status='Registered'),
+                       active = (select count(id) from clients where status='Active'),
+                       outsync = (select count(id) from clients where sync_status='Out of Sync'),
+                       thresholds = (select count(id) from clients where threshold!=0)
+                     where id = 1 """)
+
+
+def move_event_logs(conn):
+    """ copy the logs still stored in events to event_logs, compressed
+    :param conn: Connection object
+    """
+    rows = conn.execute("select id, log from events where log is not null and log != 'None'")
+    conn.executemany("insert or replace into event_logs (event_id, log) values (?, ?)",
+                     ((id, compress_log(log)) for id, log in rows))
+
+
+def enable_incremental_vacuum(conn):
+    """ switch auto_vacuum to INCREMENTAL, needs one full vacuum outside a transaction
+    :param conn: Connection object
+    """
+    if conn.execute("pragma auto_vacuum").fetchone()[0] != 2:
+        conn.commit()
+        conn.execute("pragma auto_vacuum = INCREMENTAL")
+        conn.execute("vacuum")
+
+
+# Schema migrations, applied in order at app init.
+# The current version is stored in the sqlite user_version pragma, every
+# entry is (version, [statements]) and runs once in its own transaction.
+# A statement is either sql or a callable taking the connection.
+# Never edit a released entry, append a new version instead.
+
+migrations = [
+    (1, [
+        # duplicated names break exist() checks, keep the oldest row
+        "delete from clients where id not in (select min(id) from clients group by name)",
+        "delete from shares where id not in (select min(id) from shares group by name)",
+        "create unique index if not exists idx_clients_name on clients (name)",
+        "create unique index if not exists idx_shares_name on shares (name)",
+        # sync_end update and per client event lists
+        "create index if not exists idx_events_client_start_ts on events (client, start_ts)",
+        # last OK / pending lookups and per client counters
+        "create index if not exists idx_events_client_status_id on events (client, status, id)",
+        # /clients last seen
+        "create index if not exists idx_events_client_end_ts on events (client, end_ts)",
+        # /events filters, default ordering
+        "create index if not exists idx_events_status_start_ts on events (status, start_ts)",
+        "create index if not exists idx_events_sync_status_start_ts on events (sync_status, start_ts)",
+        "create index if not exists idx_events_start_ts on events (start_ts)",
+    ]),
+    (2, [
+        # home dashboard counters, single row kept up to date by triggers
+        """ create table if not exists stats (
+              id INTEGER PRIMARY KEY CHECK (id = 1),
+              nevents INTEGER NOT NULL DEFAULT 0,
+              nevents_ok INTEGER NOT NULL DEFAULT 0,
+              nevents_ko INTEGER NOT NULL DEFAULT 0,
+              nclients INTEGER NOT NULL DEFAULT 0,
+              nshares INTEGER NOT NULL DEFAULT 0,
+              toregister INTEGER NOT NULL DEFAULT 0,
+              active INTEGER NOT NULL DEFAULT 0,
+              outsync INTEGER NOT NULL DEFAULT 0,
+              thresholds INTEGER NOT NULL DEFAULT 0) """,
+        "insert or ignore into stats (id) values (1)",
+        """ create trigger if not exists stats_events_insert after insert on events begin
+              update stats set nevents = nevents + 1,
+                               nevents_ok = nevents_ok + (new.status = 'OK'),
+                               nevents_ko = nevents_ko + (new.status = 'KO')
+              where id = 1;
+            end """,
+        """ create trigger if not exists stats_events_update after update of status on events begin
+              update stats set nevents_ok = nevents_ok + (new.status = 'OK') - (old.status = 'OK'),
+                               nevents_ko = nevents_ko + (new.status = 'KO') - (old.status = 'KO')
+              where id = 1;
+            end """,
+        """ create trigger if not exists stats_events_delete after delete on events begin
+              update stats set nevents = nevents - 1,
+                               nevents_ok = nevents_ok - (old.status = 'OK'),
+                               nevents_ko = nevents_ko - (old.status = 'KO')
+              where id = 1;
+            end """,
+        """ create trigger if not exists stats_clients_insert after insert on clients begin
+              update stats set nclients = nclients + 1,
+                               toregister = toregister + (new.status = 'Registered'),
+                               active = active + (new.status = 'Active'),
+                               outsync = outsync + ifnull(new.sync_status = 'Out of Sync', 0),
+                               thresholds = thresholds + (new.threshold != 0)
+              where id = 1;
+            end """,
+        """ create trigger if not exists stats_clients_update after update on clients begin
+              update stats set toregister = toregister + (new.status = 'Registered') - (old.status = 'Registered'),
+                               active = active + (new.status = 'Active') - (old.status = 'Active'),
+                               outsync = outsync + ifnull(new.sync_status = 'Out of Sync', 0)
+                                                 - ifnull(old.sync_status = 'Out of Sync', 0),
+                               thresholds = thresholds + (new.threshold != 0) - (old.threshold != 0)
+              where id = 1;
+            end """,
+        """ create trigger if not exists stats_clients_delete after delete on clients begin
+              update stats set nclients = nclients - 1,
+                               toregister = toregister - (old.status = 'Registered'),
+                               active = active - (old.status = 'Active'),
+                               outsync = outsync - ifnull(old.sync_status = 'Out of Sync', 0),
+                               thresholds = thresholds - (old.threshold != 0)
+              where id = 1;
+            end """,
+        """ create trigger if not exists stats_shares_insert after insert on shares begin
+              update stats set nshares = nshares + 1 where id = 1;
+            end """,
+        """ create trigger if not exists stats_shares_delete after delete on shares begin
+              update stats set nshares = nshares - 1 where id = 1;
+            end """,
+        reconcile_stats,
+    ]),
+    (3, [
+        # /events share filter
+        "create index if not exists idx_events_share_start_ts on events (share, start_ts)",
+    ]),
+    (4, [
+        # sync logs move out of events, compressed, see event_mgt
+        """ create table if not exists event_logs (
+              event_id INTEGER PRIMARY KEY,
+              log BLOB NOT NULL) """,
+        move_event_logs,
+        "update events set log = null where log is not null",
+    ]),
+    (5, [
+        # let the log purge free pages a batch at a time instead of a full vacuum
+        enable_incremental_vacuum,
+    ]),
+    (6, [
+        # rolled up events keep counting on the dashboard
+        """ create trigger if not exists stats_rollup_insert after insert on events_rollup begin
+              update stats set nevents = nevents + new.total,
+                               nevents_ok = nevents_ok + new.ok,
+                               nevents_ko = nevents_ko + new.ko
+              where id = 1;
+            end """,
+        """ create trigger if not exists stats_rollup_update after update on events_rollup begin
+              update stats set nevents = nevents + new.total - old.total,
+                               nevents_ok = nevents_ok + new.ok - old.ok,
+                               nevents_ko = nevents_ko + new.ko - old.ko
+              where id = 1;
+            end """,
+        """ create trigger if not exists stats_rollup_delete after delete on events_rollup begin
+              update stats set nevents = nevents - old.total,
+                               nevents_ok = nevents_ok - old.ok,
+                               nevents_ko = nevents_ko - old.ko
+              where id = 1;
+            end """,
+        "create index if not exists idx_events_rollup_period on events_rollup (period, period_ts)",
+        reconcile_stats,
+    ]),
+    (7, [
+        # share size as integers, filled by the next scan
+        "alter table shares add column size_bytes INTEGER",
+        "alter table shares add column files INTEGER",
+        "alter table shares add column size_ts INTEGER",
+    ]),
+    (8, [
+        # share scan jobs, see share_scan
+        """ create table if not exists share_scans (
+              share TEXT PRIMARY KEY,
+              state TEXT NOT NULL,
+              queued_ts INTEGER NOT NULL,
+              started_ts INTEGER,
+              finished_ts INTEGER,
+              dirs INTEGER NOT NULL,
+              bytes INTEGER NOT NULL,
+              files INTEGER NOT NULL,
+              error TEXT,
+              cancel INTEGER NOT NULL) """,
+    ]),
+    (9, [
+        # unison result counts reported by the agent, null for older agents
+        "alter table events add column files_transferred INTEGER",
+        "alter table events add column files_skipped INTEGER",
+        "alter table events add column files_failed INTEGER",
+        "alter table events add column conflicts INTEGER",
+        "alter table events add column bytes_transferred INTEGER",
+        "alter table events_rollup add column files_transferred INTEGER NOT NULL DEFAULT 0",
+        "alter table events_rollup add column bytes_transferred INTEGER NOT NULL DEFAULT 0",
+    ]),
+    (10, [
+        # process running a size scan and its last sign of life, see share_scan
+        "alter table share_scans add column pid INTEGER",
+        "alter table share_scans add column heartbeat_ts INTEGER",
+    ]),
+    (11, [
+        # last run of each scheduled task, JSON metrics, see scheduler_tasks
+        """ create table if not exists scheduler_stats (
+              task TEXT PRIMARY KEY,
+              last_run INTEGER NOT NULL,
+              stats TEXT NOT NULL) """,
+    ]),
+]
+
+
+def schema_version(conn):
+    return conn.execute("pragma user_version").fetchone()[0]
+
+
+def migrate(conn):
+    """ bring the database schema to the latest version
+    :param conn: Connection object
+    :return: schema version after the migration
+    """
+    current = schema_version(conn)
+    for version, statements in migrations:
+        if version <= current:
+            continue
+        try:
+            if not conn.in_transaction:
+                conn.execute("begin")
+            for statement in statements:
+                if callable(statement):
+                    statement(conn)
+                else:
+                    conn.execute(statement)
+            conn.execute("pragma user_version = %d" % version)
+            conn.commit()
+        except Error as e:
+            conn.rollback()
+            print("Schema migration to version %d failed: %s" % (version, e))
+            break
+        current = version
+        print("Schema migrated to version %d" % version)
+    return current
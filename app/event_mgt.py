@@ -0,0 +1,257 @@
+import json
+import math
+import zlib
+from db_conn import get_db, query_db, modify_db
+
+# sync logs live zlib compressed in event_logs, keyed by event id, so the
+# events rows stay small and only /events/<id> reads them
+
+def compress_log(log):
+    return zlib.compress(log.encode('utf-8'))
+
+def decompress_log(data):
+    return zlib.decompress(data).decode('utf-8')
+
+# /sync/batch limits, the body size is checked after decompression
+sync_batch_max_bytes = 32 * 1024 * 1024
+sync_batch_max_events = 1000
+
+def decode_json(data, encoding=None):
+    """ JSON request body, gzip or deflate compressed when Content-Encoding says so
+    :return: decoded body, None if it is not valid or too large
+    """
+    encoding = (encoding or '').lower()
+    if encoding in ('gzip', 'deflate'):
+        # wbits 32+ accepts both zlib and gzip headers, max_length bounds a compression bomb
+        d = zlib.decompressobj(47)
+        try:
+            data = d.decompress(data, sync_batch_max_bytes + 1)
+        except zlib.error:
+            return None
+    elif encoding not in ('', 'identity'):
+        return None
+    if len(data) > sync_batch_max_bytes:
+        return None
+    try:
+        return json.loads(data)
+    except ValueError:
+        return None
+
+# events older than the rollup age are compacted in events_rollup, one row
+# per client, share and hour (later day); p95 of merged rows is the max of
+# their p95, an upper bound
+rollup_upsert = """ insert into events_rollup (client, share, period, period_ts, total, ok, ko, warning,
+                        changed, unchanged, duration_sum, duration_count, duration_p95,
+                        files_transferred, bytes_transferred)
+                      values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+                      on conflict (client, share, period, period_ts) do update set
+                        total = total + excluded.total,
+                        ok = ok + excluded.ok,
+                        ko = ko + excluded.ko,
+                        warning = warning + excluded.warning,
+                        changed = changed + excluded.changed,
+                        unchanged = unchanged + excluded.unchanged,
+                        duration_sum = duration_sum + excluded.duration_sum,
+                        duration_count = duration_count + excluded.duration_count,
+                        duration_p95 = max(ifnull(duration_p95, 0), ifnull(excluded.duration_p95, 0)),
+                        files_transferred = files_transferred + excluded.files_transferred,
+                        bytes_transferred = bytes_transferred + excluded.bytes_transferred """
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, int(math.ceil(p * len(values))) - 1)]
+
+class EventMgt(object):
+    columns = "client, start_ts, end_ts, status, duration, share, id, sync_status"
+    filters = ['client', 'share', 'status', 'sync_status']
+    # unison result counts, see app_client/unison_result.py
+    metrics = ['files_transferred', 'files_skipped', 'files_failed', 'conflicts', 'bytes_transferred']
+    def __init__(self, id=None):
+        self.id = id
+
+    def search(self, limit=50, since=None, until=None, before=None, **filters):
+        """ events matching every given filter, newest first
+        :param filters: column=value for client, share, status, sync_status, None or "ALL" match everything
+        :param since: start_ts lower bound, included
+        :param until: start_ts upper bound, excluded
+        :param before: (start_ts, id) of the last event already shown, keyset cursor for the next page
+        :return: list of rows in columns order
+        """
+        where = []
+        args = []
+        for column in self.filters:
+            value = filters.get(column)
+            if value is not None and value != "ALL":
+                where.append("%s = ?" % column)
+                args.append(value)
+        if since is not None:
+            where.append("start_ts >= ?")
+            args.append(since)
+        if until is not None:
+            where.append("start_ts < ?")
+            args.append(until)
+        if before is not None:
+            # the start_ts <= bound lets sqlite seek the index instead of filtering
+            where.append("start_ts <= ? and (start_ts < ? or id < ?)")
+            args.extend([before[0], before[0], before[1]])
+        query = "select %s from events" % self.columns
+        if where:
+            query += " where " + " and ".join(where)
+        query += " order by start_ts desc, id desc limit ?"
+        args.append(int(limit))
+        return query_db(query, args)
+
+    def start(self, client, start_ts, share, commit=True):
+        """ open a SYNCING event for client """
+        query = "insert into events (client,start_ts,share,status) values (?,?,?,'SYNCING')"
+        return modify_db(query, (client, start_ts, share), commit)
+
+    @classmethod
+    def parse_metrics(cls, values):
+        """ metrics found in values (form or JSON event) as integers, missing ones are None """
+        result = {}
+        for m in cls.metrics:
+            value = values.get(m)
+            result[m] = int(value) if value not in (None, '') else None
+        return result
+
+    def end(self, client, start_ts, status, sync_status, end_ts, log, metrics=None, commit=True):
+        """ close the SYNCING event of client started at start_ts and store its log
+        :param metrics: parse_metrics result, None if the agent sent none
+        :return: number of events updated
+        """
+        metrics = metrics or {}
+        query = """ update events set status=?, sync_status=?, end_ts=?, duration=?, files_transferred=?,
+                      files_skipped=?, files_failed=?, conflicts=?, bytes_transferred=?
+                    where client=? and start_ts=? """
+        args = (status, sync_status, end_ts, end_ts - start_ts) + tuple(metrics.get(m) for m in self.metrics)
+        updated = modify_db(query, args + (client, start_ts), commit=False)
+        if log is not None:
+            query = "insert or replace into event_logs (event_id, log) select id, ? from events where client=? and start_ts=?"
+            modify_db(query, (compress_log(log), client, start_ts), commit=False)
+        if commit:
+            get_db().commit()
+        return updated
+
+    def record(self, client, events, commit=True):
+        """ store finished syncs of client in one transaction, one commit for the whole batch
+        an event whose client and start_ts already exist (started with /sync/start or sent twice) is updated
+        :param events: list of dicts with share, start_ts, end_ts, status, sync_status and optional log
+        :return: number of events stored, raises ValueError, TypeError, OverflowError or sqlite3.IntegrityError
+                 on a malformed event
+        """
+        for e in events:
+            if not isinstance(e, dict):
+                raise TypeError("event is not an object")
+            for field in ('share', 'status', 'sync_status', 'log'):
+                if e.get(field) is not None and not isinstance(e[field], str):
+                    raise ValueError("%s must be a string" % field)
+            for field in ('share', 'status'):
+                if e.get(field) is None:
+                    raise ValueError("%s is required" % field)
+            for field in ('start_ts', 'end_ts'):
+                if not isinstance(e.get(field), int) or isinstance(e[field], bool):
+                    raise ValueError("%s must be an integer" % field)
+        db = get_db()
+        update = """ update events set share=?, status=?, sync_status=?, end_ts=?, duration=?, files_transferred=?,
+                       files_skipped=?, files_failed=?, conflicts=?, bytes_transferred=?
+                     where client=? and start_ts=? """
+        insert = """ insert into events (client, start_ts, share, status, sync_status, end_ts, duration, files_transferred,
+                       files_skipped, files_failed, conflicts, bytes_transferred)
+                     values (?,?,?,?,?,?,?,?,?,?,?,?) """
+        try:
+            for e in events:
+                start_ts = int(e['start_ts'])
+                end_ts = int(e['end_ts'])
+                metrics = self.parse_metrics(e)
+                args = (e.get('share'), e['status'], e.get('sync_status'), end_ts, end_ts - start_ts) + \
+                       tuple(metrics[m] for m in self.metrics)
+                if db.execute(update, args + (client, start_ts)).rowcount == 0:
+                    db.execute(insert, (client, start_ts) + args)
+                if e.get('log') is not None:
+                    query = "insert or replace into event_logs (event_id, log) select id, ? from events where client=? and start_ts=?"
+                    db.execute(query, (compress_log(e['log']), client, start_ts))
+        except Exception:
+            if commit:
+                db.rollback()
+            raise
+        if commit:
+            db.commit()
+        return len(events)
+
+    def detail(self):
+        """ id, client, status, log, start_ts, end_ts, duration, share and metrics dict of the event,
+        log is "None" once purged, metrics are None when the agent did not report them """
+        query = """ select events.id, events.client, events.status, event_logs.log,
+                      events.start_ts, events.end_ts, events.duration, events.share,
+                      events.files_transferred, events.files_skipped, events.files_failed,
+                      events.conflicts, events.bytes_transferred
+                    from events
+                    left join event_logs on event_logs.event_id = events.id
+                    where events.id = ? """
+        row = query_db(query, (self.id,), one=True)
+        if row is None:
+            return None
+        log = "None" if row[3] is None else decompress_log(row[3])
+        return row[:3] + (log,) + row[4:8] + (dict(zip(self.metrics, row[8:])),)
+
+    def rollup_hour(self, cutoff):
+        """ compact the oldest hour of finished events started before cutoff
+        :param cutoff: timestamp, aligned to the hour
+        :return: number of raw events compacted, 0 when nothing is left
+        """
+        query = "select min(start_ts) from events where start_ts < ? and status != 'SYNCING'"
+        oldest = query_db(query, (cutoff,))[0][0]
+        if oldest is None:
+            return 0
+        hour = int(oldest) // 3600 * 3600
+        query = """ select client, share, status, sync_status, duration, files_transferred, bytes_transferred from events
+                    where start_ts >= ? and start_ts < ? and status != 'SYNCING' """
+        groups = {}
+        for client, share, status, sync_status, duration, files, size in query_db(query, (hour, hour + 3600)):
+            g = groups.setdefault((client, share), {'total': 0, 'OK': 0, 'KO': 0, 'WARNING': 0,
+                                                    'CHANGED': 0, 'UNCHANGED': 0, 'durations': [],
+                                                    'files': 0, 'bytes': 0})
+            g['total'] += 1
+            if status in g:
+                g[status] += 1
+            if sync_status in ('CHANGED', 'UNCHANGED'):
+                g[sync_status] += 1
+            if duration is not None:
+                g['durations'].append(duration)
+            g['files'] += files or 0
+            g['bytes'] += size or 0
+        rows = []
+        for (client, share), g in groups.items():
+            rows.append((client, share, 'hour', hour, g['total'], g['OK'], g['KO'], g['WARNING'],
+                         g['CHANGED'], g['UNCHANGED'], sum(g['durations']), len(g['durations']),
+                         percentile(g['durations'], 0.95), g['files'], g['bytes']))
+        db = get_db()
+        db.executemany(rollup_upsert, rows)
+        query = """ delete from event_logs where event_id in
+                      (select id from events where start_ts >= ? and start_ts < ? and status != 'SYNCING') """
+        modify_db(query, (hour, hour + 3600), commit=False)
+        query = "delete from events where start_ts >= ? and start_ts < ? and status != 'SYNCING'"
+        compacted = modify_db(query, (hour, hour + 3600), commit=False)
+        db.commit()
+        return compacted
+
+    def rollup_days(self, cutoff):
+        """ merge hourly rollups older than cutoff into daily ones
+        :param cutoff: timestamp, aligned to the day
+        :return: number of hourly rows merged
+        """
+        query = """ select client, share, 'day', period_ts / 86400 * 86400, sum(total), sum(ok), sum(ko), sum(warning),
+                      sum(changed), sum(unchanged), sum(duration_sum), sum(duration_count), max(duration_p95),
+                      sum(files_transferred), sum(bytes_transferred)
+                    from events_rollup where period = 'hour' and period_ts < ?
+                    group by client, share, period_ts / 86400 """
+        rows = query_db(query, (cutoff,))
+        db = get_db()
+        db.executemany(rollup_upsert, rows)
+        query = "delete from events_rollup where period = 'hour' and period_ts < ?"
+        merged = modify_db(query, (cutoff,), commit=False)
+        db.commit()
+        return merged
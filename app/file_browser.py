@@ -0,0 +1,129 @@
+import os
+import stat
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+# Directory listings are cached per directory, keyed by its mtime: adding,
+# removing or renaming an entry changes the directory mtime, so a cached
+# listing is reused until the directory itself changes. Each listing keeps
+# its entries once, in name order, plus an index array per other sort key,
+# pages are then a bisect on the cursor and a slice, whatever the directory
+# size. The cache is bounded by the entries it holds, not by directories.
+
+listing_cache_entries = 200000
+listing_cache = OrderedDict()
+listing_cache_lock = threading.Lock()
+listing_cache_total = 0
+
+# sort name -> key of an entry (name, is_dir, size, mtime), directories first
+sort_keys = {
+    'name':  lambda e: (not e[1], e[0]),
+    'size':  lambda e: (not e[1], e[2], e[0]),
+    'mtime': lambda e: (not e[1], e[3], e[0]),
+}
+
+def resolve(root, path):
+    """ absolute path of path inside root
+    :return: None if path escapes root, through .. or a symlink
+    """
+    root = os.path.realpath(root)
+    full = os.path.realpath(os.path.join(root, path.lstrip('/')))
+    if full != root and not full.startswith(os.path.join(root, '')):
+        return None
+    return full
+
+def file_etag(st):
+    """ strong validator from inode, mtime and size, unison replaces files through a rename so the inode changes too """
+    return "%x-%x-%x" % (st.st_ino, st.st_mtime_ns, st.st_size)
+
+class SortedView(object):
+    """ entries in the order of an index array, as a sequence bisect can search
+    :param key: view the sort keys instead of the entries
+    """
+    def __init__(self, entries, order=None, key=None):
+        self.entries = entries
+        self.order = order
+        self.key = key
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, i):
+        entry = self.entries[i if self.order is None else self.order[i]]
+        return entry if self.key is None else self.key(entry)
+
+def scan_listing(path):
+    entries = []
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                # removed while listing
+                continue
+            entries.append((entry.name, stat.S_ISDIR(st.st_mode), st.st_size, int(st.st_mtime)))
+    entries.sort(key=sort_keys['name'])
+    orders = {'name': None}
+    for sort, key in sort_keys.items():
+        if sort != 'name':
+            orders[sort] = array('I', sorted(range(len(entries)), key=lambda i: key(entries[i])))
+    return entries, orders
+
+def get_listing(path):
+    """ entries of directory path in name order and the index array of every other sort key,
+    from the cache while its mtime is unchanged
+    """
+    global listing_cache_total
+    mtime = os.stat(path).st_mtime_ns
+    with listing_cache_lock:
+        cached = listing_cache.get(path)
+        if cached is not None and cached[0] == mtime:
+            listing_cache.move_to_end(path)
+            return cached[1]
+    listing = scan_listing(path)
+    with listing_cache_lock:
+        old = listing_cache.pop(path, None)
+        if old is not None:
+            listing_cache_total -= len(old[1][0])
+        listing_cache[path] = (mtime, listing)
+        listing_cache_total += len(listing[0])
+        # the newest listing stays, even alone above the limit
+        while listing_cache_total > listing_cache_entries and len(listing_cache) > 1:
+            _, (_, evicted) = listing_cache.popitem(last=False)
+            listing_cache_total -= len(evicted[0])
+    return listing
+
+def make_cursor(entry):
+    return "%d:%d:%d:%s" % (not entry[1], entry[2], entry[3], entry[0])
+
+def list_dir(path, sort='name', reverse=False, after=None, limit=500):
+    """ one page of the entries of directory path
+    :param sort: name, size or mtime, directories sort before files
+    :param reverse: descending order
+    :param after: cursor of the last entry already shown
+    :return: (entries, cursor of the next page or None), entries are (name, is_dir, size, mtime)
+    """
+    entries, orders = get_listing(path)
+    entries = SortedView(entries, orders[sort])
+    keys = SortedView(entries.entries, orders[sort], sort_keys[sort])
+    key = None
+    if after is not None:
+        not_dir, size, mtime, name = after.split(':', 3)
+        key = {'name':  (bool(int(not_dir)), name),
+               'size':  (bool(int(not_dir)), int(size), name),
+               'mtime': (bool(int(not_dir)), int(mtime), name)}[sort]
+    if reverse:
+        # keys are ascending, walk them backwards from the cursor
+        end = len(keys) if key is None else bisect_left(keys, key)
+        page = [entries[i] for i in range(end - 1, max(0, end - limit) - 1, -1)]
+        more = end - limit > 0
+    else:
+        start = 0 if key is None else bisect_right(keys, key)
+        page = [entries[i] for i in range(start, min(start + limit, len(entries)))]
+        more = start + limit < len(entries)
+    cursor = None
+    if page and more:
+        cursor = make_cursor(page[-1])
+    return page, cursor
@@ -7,55 +7,58 @@ import time
 from db_conn import get_db, query_db
 
 
+# cpu/memory/load snapshot, refreshed by the scheduler every sample_interval
+# seconds so the home page never measures inline
+sample_interval = 10
+sys_sample = {}
+
+def homestats_sample():
+    av1, av2, av3 = os.getloadavg()
+    sys_sample.update({'av1': round(av1,2), 'av2': round(av2,2), 'av3': round(av3,2),
+                       'cpu_percent': psutil.cpu_percent(), 'memory_percent': psutil.virtual_memory().percent,
+                       'boot_time': psutil.boot_time(), 'sample_ts': time.time()})
+    return sys_sample
+
 def homestats_sys(startTime):
     result={}
-    av1, av2, av3 = os.getloadavg()
-    av1 = round(av1,2)
-    av2 = round(av2,2)
-    av3 = round(av3,2)
-    cpu_percent = psutil.cpu_percent()
-    memory_percent = psutil.virtual_memory().percent
-    bootDelta = int(time.time() - psutil.boot_time())
+    sample = sys_sample
+    # processes without a running scheduler (forked workers) resample here,
+    # every psutil call below is non-blocking
+    if time.time() - sample.get('sample_ts', 0) > sample_interval * 2:
+        sample = homestats_sample()
+    bootDelta = int(time.time() - sample['boot_time'])
     processDelta = int(time.time() - startTime)
     boot_uptime = homestats_uptime(bootDelta)
     process_uptime = homestats_uptime(processDelta)
-    result.update({'av1': av1, 'av2': av2, 'av3': av3, 'cpu_percent': cpu_percent, 'memory_percent': memory_percent,
+    result.update({'av1': sample['av1'], 'av2': sample['av2'], 'av3': sample['av3'],
+                   'cpu_percent': sample['cpu_percent'], 'memory_percent': sample['memory_percent'],
                    'uptime_days': process_uptime[0], 'uptime_hours': process_uptime[1], 'uptime_minutes': process_uptime[2], 'uptime_seconds': process_uptime[3],
                    'boot_uptime_days': boot_uptime[0], 'boot_uptime_hours': boot_uptime[1], 'boot_uptime_minutes': boot_uptime[2], 'boot_uptime_seconds': boot_uptime[3]
                    })
     return result
 
 def homestats_unicloud():
-    result = {}
-    query = "select count(id) from events"
-    nevents = query_db(query)
-    query = "select count(id) from events where status='OK'"
-    nevents_ok = query_db(query)
-    query = "select count(id) from events where status='KO'"
-    nevents_ko = query_db(query)
-    query = "select count(id) from clients"
-    nclients = query_db(query)
-    query = "select count(id) from shares"
-    nshares = query_db(query)
-    query = "select count(id) from clients where status='Registered'"
-    toregister = query_db(query)
-    query = "select count(id) from clients where status='Active'"
-    active = query_db(query)
-    query = "select count(id) from clients where sync_status='Out of Sync'"
-    outsync = query_db(query)
-    query = "select count(id) from clients where threshold!=0"
-    thresholds = query_db(query)
-    result.update({'nevents': nevents[0][0], 'nevents_ok': nevents_ok[0][0], 'nevents_ko': nevents_ko[0][0], 'thresholds': thresholds[0][0],
-                  'nclients': nclients[0][0], 'nshares': nshares[0][0], 'toregister': toregister[0][0], 'outsync': outsync[0][0], 'active': active[0][0]})
-    return result
+    # counters are maintained by triggers on the stats table, see db_schema
+    query = """select nevents, nevents_ok, nevents_ko, thresholds, nclients, nshares, toregister, outsync, active
+               from stats where id = 1"""
+    row = query_db(query, one=True)
+    keys = ['nevents', 'nevents_ok', 'nevents_ko', 'thresholds', 'nclients', 'nshares', 'toregister', 'outsync', 'active']
+    return dict(zip(keys, row))
+
+# versions do not change while the app runs, computed once per worker
+runtime_stats = {}
 
 def homestats_runtime():
-    result = {}
+    if runtime_stats:
+        return runtime_stats
     python_version = str(sys.version_info.major)+'.'+str(sys.version_info.minor)
-    unison_version = subprocess.check_output(['unison', '-version']).split()[2].decode('utf-8')
+    try:
+        unison_version = subprocess.check_output(['unison', '-version']).split()[2].decode('utf-8')
+    except (OSError, subprocess.CalledProcessError, IndexError):
+        unison_version = "None"
     flask_version = flask.__version__
-    result.update({'python_version': python_version, 'unison_version': unison_version, 'flask_version': flask_version })
-    return result
+    runtime_stats.update({'python_version': python_version, 'unison_version': unison_version, 'flask_version': flask_version })
+    return runtime_stats
 
 def homestats_uptime(seconds):
     result = []
@@ -68,3 +71,5 @@ def homestats_uptime(seconds):
         result.append(f)
     return result
 
+homestats_runtime()
+homestats_sample()
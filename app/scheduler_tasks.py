@@ -1,57 +1,137 @@
+import json
+import time
 from client_mgt import ClientMgt
 from share_mgt import ShareMgt
-from db_conn import get_db, query_db
+from share_scan import submit_scan
+from event_mgt import EventMgt
+from db_conn import get_db, query_db, modify_db
+from db_schema import reconcile_stats
 from conf import *
 
+# last run metrics of the scheduled tasks, exposed on /scheduler/stats; in the
+# scheduler_stats table because the scheduler runs in the uwsgi master only
+# and the workers serving the endpoint would never see a process local copy
+
+def record_stats(task, stats):
+    query = """ insert into scheduler_stats (task, last_run, stats) values (?, ?, ?)
+                on conflict (task) do update set last_run = excluded.last_run, stats = excluded.stats """
+    modify_db(query, (task, stats['last_run'], json.dumps(stats)))
+
+def read_stats():
+    """ last run metrics of every task that ran, by task name """
+    return dict((task, json.loads(stats)) for task, stats in query_db("select task, stats from scheduler_stats"))
+
 
 def scheduler_tasks_update_sync_status(app):
     with app.app_context():
+        start = time.time()
         cl = ClientMgt("all")
-        client_list = cl.list_clients_threshold()
-        if client_list:
-            #print("Found some clients with a threshold defined..")
-            for c in client_list:
-                #print(c)
-                c_status = ClientMgt(c[0])
-                sync_status = c_status.sync_status(type='real_status')
-                #print(sync_status)
-                c_status.update_sync_status(sync_status)
-        #else:
-        #  print("No Client with threshold defined")
-        #return client_list
+        updated = cl.refresh_sync_status(int(start))
+        record_stats('update_sync_status', {'last_run': int(start), 'clients': updated,
+                                            'duration_ms': round((time.time() - start) * 1000, 2)})
+
+def scheduler_tasks_reconcile_stats(app):
+    with app.app_context():
+        start = time.time()
+        reconcile_stats(get_db())
+        get_db().commit()
+        record_stats('reconcile_stats', {'last_run': int(start),
+                                         'duration_ms': round((time.time() - start) * 1000, 2)})
 
 def scheduler_tasks_share_update_size(app):
     with app.app_context():
+      start = time.time()
       share = ShareMgt("all")
       share_list = share.share_list()
-      if share_list:
-          #print("Found some shares")
-          for s in share_list:
-              #print (s[0])
-              s_size = ShareMgt(s[0])
-              s_size.updatesize()
-              #print(size)
+      for s in share_list:
+          # no directory cache: files rewritten in place do not change their directory mtime
+          submit_scan(s[0], use_cache=False)
+      record_stats('share_update_size', {'last_run': int(start), 'shares': len(share_list),
+                                         'duration_ms': round((time.time() - start) * 1000, 2)})
+
+def scheduler_tasks_share_update_changed(app):
+    with app.app_context():
+      start = time.time()
+      share = ShareMgt("all")
+      share_list = share.changed_shares()
+      for s in share_list:
+          submit_scan(s[0])
+      record_stats('share_update_changed', {'last_run': int(start), 'shares': len(share_list),
+                                            'duration_ms': round((time.time() - start) * 1000, 2)})
+
+# log purge runs in short transactions so the sync endpoints only ever
+# wait for one batch, and gives the freed pages back incrementally
+purge_batch = 500
+purge_pause = 0.05
+purge_vacuum_pages = 2000
+
+def purge_event_logs(select_ids, args):
+    """ delete event_logs rows returned by select_ids, purge_batch at a time
+    :param select_ids: query selecting event_id, its last parameter is the batch limit
+    :param args: query parameters before the limit
+    :return: number of logs deleted
+    """
+    deleted = 0
+    query = "delete from event_logs where event_id in (%s)" % select_ids
+    while True:
+        count = modify_db(query, tuple(args) + (purge_batch,))
+        deleted += count
+        if count < purge_batch:
+            return deleted
+        time.sleep(purge_pause)
 
 def scheduler_tasks_purge_logs(app):
     with app.app_context():
+        start = time.time()
+        deleted = 0
+        # count retention, last max_log_events logs overall
         query = "select max(id) from events"
-        maxid = query_db(query)
-        if maxid[0][0] > int(max_log_events):
-           query = "select max(id-%d) from events where log!=''" % int(max_log_events)
-           #print(query)
-           start_id_to_delete = query_db(query)
-           query = "update events set log='None' where id < %d" % start_id_to_delete[0][0]
-           #print(query)
-           query_db(query)
-           get_db().commit()
-           query = "vacuum"
-           query_db(query)
-           get_db().commit()
+        maxid = query_db(query)[0][0]
+        if maxid is not None and maxid > int(max_log_events):
+           query = "select event_id from event_logs where event_id < ? limit ?"
+           deleted += purge_event_logs(query, (maxid - int(max_log_events),))
         else:
            print("Not reached max log events yet : %d" % int(max_log_events))
+        # age retention, logs of syncs started more than max_log_days ago
+        if int(max_log_days) > 0:
+           # by the event own start_ts, ids do not follow it (batch reports and wrong clocks come late)
+           query = """select event_logs.event_id from event_logs
+                      join events on events.id = event_logs.event_id
+                      where events.start_ts < ? limit ?"""
+           deleted += purge_event_logs(query, (int(start) - int(max_log_days) * 86400,))
+        # per client count retention, last max_client_logs logs of each client
+        if int(max_client_logs) > 0:
+           cl = ClientMgt("all")
+           for c in cl.list_clients():
+              query = "select id from events where client=? order by id desc limit 1 offset ?"
+              cutoff = query_db(query, (c[0], int(max_client_logs) - 1), one=True)
+              if cutoff is not None:
+                 query = """select event_logs.event_id from events
+                            join event_logs on event_logs.event_id = events.id
+                            where events.client = ? and events.id < ? limit ?"""
+                 deleted += purge_event_logs(query, (c[0], cutoff[0]))
+        # auto_vacuum is incremental (schema version 5), release a bounded number of free pages
+        query_db("pragma incremental_vacuum(%d)" % purge_vacuum_pages)
+        record_stats('purge_logs', {'last_run': int(start), 'deleted': deleted,
+                                    'duration_ms': round((time.time() - start) * 1000, 2)})
 
-
-#import sqlite3
-#conn = sqlite3.connect('my_test.db', isolation_level=None)
-#conn.execute("VACUUM")
-#conn.close()
\ No newline at end of file
+def scheduler_tasks_rollup_events(app):
+    with app.app_context():
+        if int(rollup_days) <= 0:
+            return
+        start = time.time()
+        events = EventMgt()
+        cutoff = (int(start) - int(rollup_days) * 86400) // 3600 * 3600
+        compacted = 0
+        while True:
+            count = events.rollup_hour(cutoff)
+            if count == 0:
+                break
+            compacted += count
+            time.sleep(purge_pause)
+        merged = 0
+        if int(rollup_daily_days) > int(rollup_days):
+            cutoff = (int(start) - int(rollup_daily_days) * 86400) // 86400 * 86400
+            merged = events.rollup_days(cutoff)
+        record_stats('rollup_events', {'last_run': int(start), 'compacted': compacted, 'merged': merged,
+                                       'duration_ms': round((time.time() - start) * 1000, 2)})
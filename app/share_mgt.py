@@ -1,8 +1,12 @@
 import os
 import errno
-from db_conn import get_db, query_db
+from db_conn import get_db, query_db, modify_db
 import shutil
-import subprocess
+import time
+from share_size import share_size, human_size
+
+# longest sync changed_shares looks back for, see there
+max_sync_age = 86400
 
 class ShareMgt(object):
     share = ""
@@ -43,38 +47,37 @@ class ShareMgt(object):
       else:
         if self.info == "all":
            result = {}
-           query = "select name,path,description,size from shares where name='%s'" % self.name
-           q = query_db(query)
-           query2 = "select name from clients where share='%s'" % self.name
-           q2 = query_db(query2)
-           query3 = "select count(name) from clients where share='%s'" % self.name
-           q3 = query_db(query3)
+           query = "select name,path,description,size_bytes,files,size_ts from shares where name=?"
+           q = query_db(query, (self.name,))
+           query2 = "select name from clients where share=?"
+           q2 = query_db(query2, (self.name,))
+           query3 = "select count(name) from clients where share=?"
+           q3 = query_db(query3, (self.name,))
            #print (q2)
            client_list = ["".join(line) for line in q2]
            client_list_final = " - "
            client_list_final = client_list_final.join(client_list)
-           result.update({'name': q[0][0], 'path': q[0][1], 'description': q[0][2], 'size': q[0][3], 'clients': client_list_final, 'clients_count': q3[0][0] })
+           result.update({'name': q[0][0], 'path': q[0][1], 'description': q[0][2], 'size': human_size(q[0][3]), 'size_bytes': q[0][3], 'files': q[0][4], 'size_ts': q[0][5], 'clients': client_list_final, 'clients_count': q3[0][0] })
         elif self.info == "path":
            #result=[]
-           query = "select path from shares where name='%s'" % self.name
-           q = query_db(query)
+           query = "select path from shares where name=?"
+           q = query_db(query, (self.name,))
            #print ("Query: %s, Result: %s" % (query, q[0][0]))
            result = q[0][0]
         elif self.info == "size":
            #result=[]
-           query = "select size from shares where name='%s'" % self.name
-           q = query_db(query)
+           query = "select size_bytes from shares where name=?"
+           q = query_db(query, (self.name,))
            #print ("Query: %s, Result: %s" % (query, q[0][0]))
-           result = q[0][0]
+           result = human_size(q[0][0])
       return result
 
     def add_to_db(self, path, description):
       self.path = path
       self.decription = description
-      query = "insert into shares (name,path,description,size) values ('%s','%s','%s','None')" % (self.name, self.path, self.description)
+      query = "insert into shares (name,path,description,size) values (?,?,?,'None')"
       #print (query)
-      query_db(query)
-      get_db().commit()
+      modify_db(query, (self.name, self.path, self.description))
 
     def delete(self, path):
       self.path = path
@@ -88,40 +91,34 @@ class ShareMgt(object):
 
     def delete_from_db(self, path):
         self.path = path
-        query = "delete from shares where path = '%s'" % self.path
-        query_db(query)
-        get_db().commit()
+        query = "delete from shares where path = ?"
+        modify_db(query, (self.path,))
 
     def exist(self):
-        query = "select count(name) from shares where name='%s'" % self.name
-        result = query_db(query)
+        query = "select count(name) from shares where name=?"
+        result = query_db(query, (self.name,))
         return result[0]
 
-    def getsize(self):
-        result = []
-        #print (self.name)
-        shareinfo = self.info("all")
-        #print(shareinfo)
-        path = shareinfo['path']
-        size = shareinfo['size']
-        realsize = subprocess.check_output(['du', '-hs', path]).split()[0].decode('utf-8')
-        #print ("Size %s" % size)
-        #print ("Realsize %s" % realsize)
-        for r in realsize, size:
-            result.append(r)
-        return result
+    def getsize(self, use_cache=True, progress=None):
+        """ bytes and files under the share path, see share_size """
+        path = self.info("path")
+        return share_size(path, use_cache, progress=progress)
+
+    def updatesize(self, use_cache=True, progress=None):
+        size, files = self.getsize(use_cache, progress)
+        query = "update shares set size=?, size_bytes=?, files=?, size_ts=? where name=?"
+        modify_db(query, (human_size(size), size, files, int(time.time()), self.name))
+        return size, files
 
-    def updatesize(self):
-        #print (self.name)
-        size = self.getsize()
-        size_on_db = size[1]
-        size_on_fs = size[0]
-        #print ("Realsize %s" % realsize)
-        #print ("Size %s " % size)
-        if size_on_fs != size_on_db:
-            query = "update shares set size='%s' where name='%s'" % (size_on_fs, self.name)
-            #print (query)
-            query_db(query)
-            get_db().commit()
-        else:
-            print("Size is the same, no need to update db")
+    def changed_shares(self):
+        """ shares with a CHANGED sync event ended after their last size update
+        only syncs started at most max_sync_age before it are looked at, a range on the
+        (share, start_ts) index; longer ones are left to the full refresh
+        """
+        query = """ select name from shares
+                    where exists (select 1 from events
+                                  where events.share = shares.name
+                                    and events.start_ts > ifnull(shares.size_ts, 0) - ?
+                                    and events.sync_status = 'CHANGED'
+                                    and events.end_ts > ifnull(shares.size_ts, 0)) """
+        return query_db(query, (max_sync_age,))
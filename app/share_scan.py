@@ -0,0 +1,115 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from db_conn import query_db, modify_db
+from share_mgt import ShareMgt
+
+# Share size scans run in a bounded thread pool of the process that queued
+# them. State, progress and cancel requests live in the share_scans table,
+# so any uwsgi worker can report or cancel a scan and a share never has
+# more than one scan queued or running. The process heartbeats its rows
+# as it scans; a row whose process died (worker recycled or killed) stops
+# beating and is stale after scan_stale seconds: it can be queued again.
+
+scan_pool_size = 2
+scan_timeout = 6 * 3600
+scan_stale = 300
+progress_interval = 1
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+class ScanCancelled(Exception):
+    pass
+
+def scan_pool():
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ThreadPoolExecutor(max_workers=scan_pool_size)
+            _pool_pid = os.getpid()
+    return _pool
+
+def submit_scan(name, use_cache=True):
+    """ queue a size scan of share name
+    :return: False if a scan of the share is already queued or running
+    """
+    now = int(time.time())
+    query = """ insert into share_scans (share, state, queued_ts, dirs, bytes, files, cancel, pid, heartbeat_ts)
+                  values (?, 'queued', ?, 0, 0, 0, 0, ?, ?)
+                on conflict (share) do update set
+                  state = 'queued', queued_ts = excluded.queued_ts, started_ts = null, finished_ts = null,
+                  dirs = 0, bytes = 0, files = 0, error = null, cancel = 0,
+                  pid = excluded.pid, heartbeat_ts = excluded.heartbeat_ts
+                where state not in ('queued', 'running') or ifnull(heartbeat_ts, 0) < ? """
+    if modify_db(query, (name, now, os.getpid(), now, now - scan_stale)) == 0:
+        return False
+    scan_pool().submit(run_scan, name, use_cache)
+    return True
+
+def cancel_scan(name):
+    """ ask the scan of share name to stop, it stops at the next progress check,
+    a stale scan is marked cancelled at once
+    :return: False if no scan of the share is queued or running
+    """
+    now = int(time.time())
+    query = """ update share_scans set cancel = 1,
+                  state = case when ifnull(heartbeat_ts, 0) < ? then 'cancelled' else state end,
+                  finished_ts = case when ifnull(heartbeat_ts, 0) < ? then ? else finished_ts end
+                where share = ? and state in ('queued', 'running') """
+    return modify_db(query, (now - scan_stale, now - scan_stale, now, name)) > 0
+
+def scan_status(name=None):
+    """ scans state, a queued or running one whose process stopped beating is reported stale """
+    query = """ select share,
+                  case when state in ('queued', 'running') and ifnull(heartbeat_ts, 0) < ? then 'stale' else state end,
+                  queued_ts, started_ts, finished_ts, dirs, bytes, files, error
+                from share_scans """
+    args = (int(time.time()) - scan_stale,)
+    if name is not None:
+        query += " where share = ?"
+        args += (name,)
+    keys = ['share', 'state', 'queued_ts', 'started_ts', 'finished_ts', 'dirs', 'bytes', 'files', 'error']
+    return [dict(zip(keys, row)) for row in query_db(query, args)]
+
+def heartbeat(now):
+    """ keep the rows of this process fresh, the queued ones wait on its running scans """
+    query = "update share_scans set heartbeat_ts = ? where pid = ? and state in ('queued', 'running')"
+    modify_db(query, (int(now), os.getpid()))
+
+def run_scan(name, use_cache=True):
+    started = time.time()
+    last = [started]
+    counted = [0]
+    def progress(dirs, size, files):
+        counted[0] = dirs
+        now = time.time()
+        if now - last[0] < progress_interval:
+            return
+        last[0] = now
+        query = "update share_scans set dirs = ?, bytes = ?, files = ? where share = ?"
+        modify_db(query, (dirs, size, files, name))
+        heartbeat(now)
+        cancel = query_db("select cancel from share_scans where share = ?", (name,), one=True)
+        if cancel is None or cancel[0]:
+            raise ScanCancelled("cancelled")
+        if now - started > scan_timeout:
+            raise ScanCancelled("timeout after %d seconds" % scan_timeout)
+    query = """ update share_scans set state = 'running', started_ts = ?, pid = ?, heartbeat_ts = ?
+                where share = ? and cancel = 0 and state = 'queued' """
+    if modify_db(query, (int(started), os.getpid(), int(started), name)) == 0:
+        modify_db("update share_scans set state = 'cancelled', finished_ts = ? where share = ?", (int(started), name))
+        return
+    try:
+        size, files = ShareMgt(name).updatesize(use_cache, progress)
+    except ScanCancelled as e:
+        query = "update share_scans set state = 'cancelled', finished_ts = ?, error = ? where share = ?"
+        modify_db(query, (int(time.time()), str(e), name))
+    except Exception as e:
+        query = "update share_scans set state = 'failed', finished_ts = ?, error = ? where share = ?"
+        modify_db(query, (int(time.time()), str(e), name))
+    else:
+        query = "update share_scans set state = 'done', finished_ts = ?, dirs = ?, bytes = ?, files = ? where share = ?"
+        modify_db(query, (int(time.time()), counted[0], size, files, name))
@@ -0,0 +1,106 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+scan_workers = 4
+
+# Per directory cache: path -> (mtime_ns, own bytes, own files, subdirs).
+# A directory mtime changes when an entry is added, removed or renamed and
+# unison always writes through a temp file + rename, so an unchanged mtime
+# means the files directly inside are the same and the walker only has to
+# descend into the cached subdirectories, without listing or stat-ing files.
+# The cache is an LRU bounded by the paths it holds (directories and their
+# subdirectory lists, ~200 bytes each); a tree larger than that is walked
+# in full, as without cache, instead of growing the process.
+dir_cache_entries = 500000
+dir_cache = OrderedDict()
+dir_cache_lock = threading.Lock()
+dir_cache_total = 0
+
+def human_size(size):
+    """ du -h like representation of a size in bytes """
+    if size is None:
+        return "None"
+    for unit in ['', 'K', 'M', 'G', 'T']:
+        if size < 1024 or unit == 'T':
+            break
+        size = size / 1024.0
+    if unit == '':
+        return "%d" % size
+    return "%.1f%s" % (size, unit)
+
+def scan_dir(path, use_cache=True):
+    """ bytes and files directly inside path and its subdirectories """
+    global dir_cache_total
+    mtime = os.lstat(path).st_mtime_ns
+    if use_cache:
+        with dir_cache_lock:
+            cached = dir_cache.get(path)
+            if cached is not None and cached[0] == mtime:
+                dir_cache.move_to_end(path)
+                return cached[1:]
+    size = 0
+    files = 0
+    subdirs = []
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                else:
+                    size += entry.stat(follow_symlinks=False).st_size
+                    files += 1
+            except OSError:
+                # removed while walking
+                pass
+    with dir_cache_lock:
+        old = dir_cache.pop(path, None)
+        if old is not None:
+            dir_cache_total -= 1 + len(old[3])
+        dir_cache[path] = (mtime, size, files, subdirs)
+        dir_cache_total += 1 + len(subdirs)
+        while dir_cache_total > dir_cache_entries and len(dir_cache) > 1:
+            _, evicted = dir_cache.popitem(last=False)
+            dir_cache_total -= 1 + len(evicted[3])
+    return size, files, subdirs
+
+def share_size(path, use_cache=True, workers=scan_workers, progress=None):
+    """ total bytes and files under path, directories are scanned in a thread pool
+    :param path: share root
+    :param use_cache: skip directories whose mtime did not change since the last walk
+    :param progress: called as progress(dirs, bytes, files) as directories complete,
+                     an exception raised there stops the walk and is re-raised
+    :return: (bytes, files)
+    """
+    global dir_cache_total
+    total_size = 0
+    total_files = 0
+    visited = set()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {pool.submit(scan_dir, path, use_cache): path}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                visited.add(pending.pop(future))
+                try:
+                    size, files, subdirs = future.result()
+                except OSError:
+                    continue
+                total_size += size
+                total_files += files
+                for subdir in subdirs:
+                    pending[pool.submit(scan_dir, subdir, use_cache)] = subdir
+            if progress is not None:
+                try:
+                    progress(len(visited), total_size, total_files)
+                except Exception:
+                    for future in pending:
+                        future.cancel()
+                    raise
+    # forget directories removed since the last walk
+    prefix = os.path.join(path, '')
+    with dir_cache_lock:
+        for cached in [p for p in dir_cache if p.startswith(prefix) and p not in visited]:
+            dir_cache_total -= 1 + len(dir_cache.pop(cached)[3])
+    return total_size, total_files
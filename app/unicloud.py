@@ -1,14 +1,25 @@
+import os
+import json
+import mimetypes
+from urllib.parse import quote
 import sqlite3
 import time
 import atexit
-from flask import Flask, g, render_template, jsonify, request
+import unicodedata
+from flask import Flask, g, render_template, stream_template, jsonify, request, Response, send_file
 from flask_restful import Api, Resource, reqparse
 from flask_basicauth import BasicAuth
-from flask_autoindex import AutoIndex
 from sqlite3 import Error
 from client_mgt import ClientMgt
 from share_mgt import ShareMgt
+from event_mgt import EventMgt, decode_json, sync_batch_max_events
+from share_size import human_size
+from share_scan import submit_scan, cancel_scan, scan_status
+from file_browser import resolve, list_dir, sort_keys, file_etag
+from write_queue import WriteQueue
 from homestats import *
+from db_schema import migrate
+from db_conn import connect, get_db, query_db, modify_db, release_db
 from apscheduler.schedulers.background import BackgroundScheduler
 from scheduler_tasks import *
 from conf import *
@@ -54,6 +65,22 @@ sql_table_events = """ CREATE TABLE IF NOT EXISTS events (
                          sync_status TEXT,
                          status TEXT); """
 
+sql_table_events_rollup = """ CREATE TABLE IF NOT EXISTS events_rollup (
+                         client TEXT NOT NULL,
+                         share TEXT NOT NULL,
+                         period TEXT NOT NULL,
+                         period_ts INTEGER NOT NULL,
+                         total INTEGER NOT NULL,
+                         ok INTEGER NOT NULL,
+                         ko INTEGER NOT NULL,
+                         warning INTEGER NOT NULL,
+                         changed INTEGER NOT NULL,
+                         unchanged INTEGER NOT NULL,
+                         duration_sum INTEGER NOT NULL,
+                         duration_count INTEGER NOT NULL,
+                         duration_p95 INTEGER,
+                         PRIMARY KEY (client, share, period, period_ts)); """
+
 sql_table_clients = """ CREATE TABLE IF NOT EXISTS clients (
                          id INTEGER PRIMARY KEY,
                          name TEXT NOT NULL,
@@ -68,7 +95,7 @@ sql_table_clients = """ CREATE TABLE IF NOT EXISTS clients (
 def create_connection(db_file):
     """ create a database connection to a SQLite database """
     try:
-        conn = sqlite3.connect(db_file)
+        conn = connect(db_file)
         return conn
     except Error as e:
         print(e)
@@ -91,7 +118,11 @@ def create_table(conn, create_table_sql):
 scheduler = BackgroundScheduler()
 scheduler.add_job(func=scheduler_tasks_update_sync_status, trigger="interval", seconds=60, args=(app,))
 scheduler.add_job(func=scheduler_tasks_share_update_size, trigger="interval", hours=6, args=(app,))
-scheduler.add_job(func=scheduler_tasks_purge_logs, trigger="interval", hours=12, args=(app,))
+scheduler.add_job(func=scheduler_tasks_share_update_changed, trigger="interval", minutes=5, args=(app,))
+scheduler.add_job(func=scheduler_tasks_purge_logs, trigger="interval", hours=1, args=(app,))
+scheduler.add_job(func=scheduler_tasks_rollup_events, trigger="interval", hours=1, args=(app,))
+scheduler.add_job(func=scheduler_tasks_reconcile_stats, trigger="interval", hours=6, args=(app,))
+scheduler.add_job(func=homestats_sample, trigger="interval", seconds=sample_interval)
 scheduler.start()
 
 # Shut down the scheduler when exiting the app
@@ -104,36 +135,21 @@ conn = create_connection(database)
 if conn is not None:
      create_table(conn, sql_table_shares)
      create_table(conn, sql_table_events)
+     create_table(conn, sql_table_events_rollup)
      create_table(conn, sql_table_clients)
+     migrate(conn)
      conn.close()
 else:
     print ("Error! can't create database connection")
     print (conn)
 
 
-### FLASK DB ###
-
-def get_db():
-    db = getattr(g, '_database', None)
-    if db is None:
-        db = g._database = sqlite3.connect(database)
-        #db.row_factory = sqlite3.Row
-    return db
-
-def query_db(query, args=(), one=False):
-    cur = get_db().execute(query, args)
-    rv = cur.fetchall()
-    cur.close()
-    return (rv[0] if rv else None) if one else rv
-
 ### FILTERS
 
-# helper to close
+# connections are kept per worker, just end the request transaction
 @app.teardown_appcontext
 def close_connection(exception):
-    db = getattr(g, '_database', None)
-    if db is not None:
-      db.close()
+    release_db()
 
 @app.template_filter('dt')
 def _jinja2_filter_datetime(date, fmt=None):
@@ -145,6 +161,26 @@ def _jinja2_filter_datetime(date, fmt=None):
     else:
         return "None"
 
+def date_ts(date):
+    """ local midnight timestamp of a YYYY-MM-DD form value, None if empty or invalid """
+    try:
+        return int(time.mktime(time.strptime(date, "%Y-%m-%d")))
+    except (TypeError, ValueError):
+        return None
+
+# largest page of the paginated UI lists
+max_page_limit = 1000
+
+def page_limit(value, default):
+    """ page size from a request value, clamped to 1..max_page_limit, raises ValueError if not an integer """
+    if value is None or value == '':
+        return default
+    return max(1, min(int(value), max_page_limit))
+
+@app.template_filter('filesize')
+def _jinja2_filter_filesize(size):
+    return human_size(size)
+
 @app.template_filter('inc')
 def _jinja2_filter_inc(number):
    number += 1
@@ -155,13 +191,6 @@ def _jinja2_filter_dec(number):
     number -= 1
     return number
 
-@app.template_filter('sync_status')
-def _jinja2_filter_sync_status(client):
-    #date = int(time.time())
-    cl=ClientMgt(client)
-    sync_status = cl.sync_status()
-    #print ("Checking status for %s, status %s" % (client, sync_status)  )
-    return sync_status
 
 # HOME #
 
@@ -193,13 +222,76 @@ def about():
 
 # FILES
 # ok
-files_index = AutoIndex(app, shares_path, add_url_rules=False)
-# Custom indexing
+# Internal nginx location aliased to shares_path, see conf/nginx/default.conf
+files_accel_location = "/_shares/"
+
+def send_share_file(full):
+   """ send a file of a share, the transfer itself is left to nginx or to sendfile
+   :param full: resolved path of the file, inside shares_path
+   """
+   st = os.stat(full)
+   etag = file_etag(st)
+   if etag in request.if_none_match:
+      response = Response(status=304)
+      response.set_etag(etag)
+      return response
+   if files_accel_redirect:
+      # nginx serves the body, including Range requests, without a uwsgi worker
+      response = Response(mimetype=mimetypes.guess_type(full)[0] or 'application/octet-stream')
+      # from the resolved path, nginx serves exactly the file checked here
+      path = os.path.relpath(full, os.path.realpath(shares_path))
+      response.headers['X-Accel-Redirect'] = quote(files_accel_location + path)
+      response.headers['Accept-Ranges'] = 'bytes'
+      if request.args.get('download') is not None:
+         # as send_file as_attachment, filename* for names that are not ascii
+         name = os.path.basename(full)
+         try:
+            name.encode('ascii')
+            response.headers.set('Content-Disposition', 'attachment', filename=name)
+         except UnicodeEncodeError:
+            simple = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode('ascii')
+            response.headers.set('Content-Disposition', 'attachment', filename=simple,
+                                 **{'filename*': "UTF-8''%s" % quote(name, safe="!#$&+^`|~")})
+      response.set_etag(etag)
+      response.last_modified = st.st_mtime
+      return response
+   # Range and If-None-Match handled by werkzeug, body through wsgi.file_wrapper (uwsgi sendfile)
+   return send_file(full, conditional=True, etag=etag, last_modified=st.st_mtime,
+                    as_attachment=request.args.get('download') is not None)
+
 @app.route('/files/<path:path>', strict_slashes=False)
 @app.route("/files", strict_slashes=False, methods=['GET'])
 @basic_auth.required
-def autoindex(path='.'):
-   return files_index.render_autoindex(path)
+def autoindex(path=''):
+   full = resolve(shares_path, path)
+   if full is None or not os.path.exists(full):
+      return jsonify("File %s not found" % path), 404
+   if not os.path.isdir(full):
+      return send_share_file(full)
+   path = path.strip('/')
+   sort = request.args.get('sort', 'name')
+   if sort not in sort_keys:
+      return jsonify("Unknown sort %s" % sort), 400
+   reverse = request.args.get('order') == 'desc'
+   try:
+      limit = min(int(request.args.get('limit', 500)), 5000)
+      entries, cursor = list_dir(full, sort, reverse, request.args.get('after'), limit)
+   except (ValueError, KeyError):
+      return jsonify("Bad limit or cursor"), 400
+   if request.args.get('format') == 'json':
+      # one JSON object per line, the last one holds the next page cursor
+      def generate():
+         for name, is_dir, size, mtime in entries:
+            yield json.dumps({'name': name, 'dir': is_dir, 'size': size, 'mtime': mtime}) + "\n"
+         yield json.dumps({'next': cursor}) + "\n"
+      return Response(generate(), mimetype='application/x-ndjson')
+   return Response(stream_template("files.html", path=path, parent=os.path.dirname(path), entries=entries,
+                                   cursor=cursor, sort=sort, reverse=reverse))
+
+@app.route("/scheduler/stats", methods=['GET'])
+@basic_auth.required
+def scheduler_status():
+    return jsonify(read_stats()), 200
 
 #### CLIENTS REQUESTS #########
 
@@ -210,19 +302,36 @@ def status():
 @app.route("/clients", methods=['GET'])
 @basic_auth.required
 def clients():
-    query = """ SELECT clients.name,
-                  clients.status,
-                  clients.joindate,
-                  clients.threshold,
-                  clients.ssh_key,
-                  max(events.end_ts)
-                FROM clients
-                LEFT JOIN events on events.client = clients.name
-                GROUP BY clients.name
-                ORDER BY events.end_ts desc """
-    res = query_db(query)
-    #print (res)
-    return render_template("clients.html", clients=res)
+    # keyset pagination on (last seen desc, name), clients never seen last
+    try:
+      limit = page_limit(request.args.get('limit'), 100)
+      after_ts = request.args.get('after_ts')
+      if after_ts is not None:
+        after_ts = int(after_ts)
+    except ValueError:
+      return jsonify("Bad limit or cursor"), 400
+    after_name = request.args.get('after_name')
+    query = """ SELECT name, status, joindate, threshold, ssh_key, lastseen, sync_status
+                FROM (SELECT clients.name,
+                        clients.status,
+                        clients.joindate,
+                        clients.threshold,
+                        clients.ssh_key,
+                        ifnull((SELECT max(end_ts) FROM events WHERE events.client = clients.name),
+                               (SELECT max(period_ts) FROM events_rollup WHERE events_rollup.client = clients.name)) AS lastseen,
+                        clients.sync_status
+                      FROM clients)
+                WHERE ? IS NULL
+                   OR ifnull(lastseen, -1) < ?
+                   OR (ifnull(lastseen, -1) = ? AND name > ?)
+                ORDER BY ifnull(lastseen, -1) DESC, name
+                LIMIT ? """
+    res = query_db(query, (after_ts, after_ts, after_ts, after_name, limit))
+    next_page = None
+    if len(res) == limit:
+        last = res[-1]
+        next_page = {'after_ts': last[5] if last[5] is not None else -1, 'after_name': last[0], 'limit': limit}
+    return render_template("clients.html", clients=res, next_page=next_page)
 
 @app.route("/clients/mgt", methods=['GET'])
 @basic_auth.required
@@ -252,29 +361,24 @@ def client_status(client):
 @app.route("/clients/info/<client>", methods=['GET'])
 def client_info(client):
     cl = ClientMgt(client)
-    exist = cl.exist()
-    if exist[0] == 0:
+    status = cl.summary()
+    if status is None:
       return "Client %s does not exist, register first\n" % client, 404
     else:
-      status=cl.info()
-      return jsonify(status)
+      return jsonify(status._asdict())
 
 @app.route("/clients/info/ui/<client>", methods=['GET'])
 @basic_auth.required
 def client_info_ui(client):
-    cl=ClientMgt(client)
-    exist = cl.exist()
-    status = cl.info()
-    #print (status)
-    if status['threshold'] > 0:
-      sync_status = cl.sync_status()
-    else:
-      sync_status = 0
-    if exist[0] == 0:
+    cl = ClientMgt(client)
+    status = cl.summary()
+    if status is None:
       return "Client %s does not exist, register first\n" % client, 404
+    if status.threshold > 0:
+      sync_status = status.sync_status
     else:
-      status=cl.info()
-      return render_template("client_info.html", status=status, client=client, sync_status=sync_status)
+      sync_status = 0
+    return render_template("client_info.html", status=status._asdict(), client=client, sync_status=sync_status)
 
 @app.route("/clients/register", methods=['POST'])
 def client_register():
@@ -358,7 +462,7 @@ def set_threshold():
 @app.route("/shares", methods=['GET'])
 @basic_auth.required
 def shares():
-    query = "select name, description, size, path from shares"
+    query = "select name, description, size_bytes, path from shares"
     res = query_db(query)
     return render_template("shares.html", shares=res)
 
@@ -450,11 +554,25 @@ def share_del_process():
 @app.route("/shares/getsize/<name>/process", methods=['POST'])
 @basic_auth.required
 def share_get_size_process(name):
-    share = ShareMgt(name)
-    share.getsize()
-    result = "Refreshing Share %s size" % name
+    if submit_scan(name, use_cache=False):
+      result = "Refreshing Share %s size" % name
+    else:
+      result = "Share %s size refresh already running" % name
     return render_template("share_mgt_result.html", result=result), 200
 
+@app.route("/shares/scan/status", methods=['GET'])
+@basic_auth.required
+def share_scan_status():
+    return jsonify(scan_status(request.args.get('share'))), 200
+
+@app.route("/shares/scan/<name>/cancel", methods=['POST'])
+@basic_auth.required
+def share_scan_cancel(name):
+    if cancel_scan(name):
+      return jsonify("Scan of share %s cancelled" % name), 200
+    else:
+      return jsonify("No scan of share %s running" % name), 404
+
 
 @app.route("/shares/exist", methods=['POST'])
 def shares_exist():
@@ -479,93 +597,115 @@ def shares_exist():
 @app.route("/events", methods=['PUT','POST','GET'])
 @basic_auth.required
 def events():
-    client = request.form.get('client')
-    status = request.form.get('status')
-    sync_status = request.form.get('sync_status')
-    limit = request.form.get('limit')
-    #print ("Client %s, Status %s" % (client, status) )
-    if limit is None:
-      limit = 50
-    #print ("Client %s Status %s" % (client,status))
-
-    # ALL RESULTS
-    if client == "ALL" and  status == "ALL" and sync_status== "ALL" or client is None and status is None and sync_status is None: # ALL RESULTS
-      query = "select client, start_ts, end_ts, status, duration, share, id, sync_status from events order by start_ts desc limit %d" % int(limit)
-    # SPECIFIC CLIENT AND ALL STATUS AND ALL SYNC_STATUS
-    elif client != "ALL" and status == "ALL" and sync_status == "ALL":
-      query = "select client, start_ts, end_ts, status, duration, share, id, sync_status from events where client = '%s' order by start_ts desc limit %d" % (client,int(limit))
-    # SPECIFIC CLIENT AND SPECIFIC STATUS AND ALL SYNC_STATUS
-    elif client != "ALL" and status != "ALL" and sync_status == "ALL":
-        query = "select client, start_ts, end_ts, status, duration, share, id, sync_status from events where client = '%s' and status = '%s' order by start_ts desc limit %d" % (client, status, int(limit))
-    # SPECIFIC CLIENT AND SPECIFIC SYNC_STATUS AND ALL STATUS
-    elif client != "ALL" and sync_status != "ALL" and status == "ALL":
-        query = "select client, start_ts, end_ts, status, duration, share, id, sync_status from events where client = '%s' and sync_status = '%s' order by start_ts desc limit %d" % (client, sync_status, int(limit))
-    # SPECIFIC CLIENT AND SPECIFIC STATUS AND SPECIFIC SYNC_STATUS
-    elif client != "ALL" and status != "ALL" and sync_status != "ALL":
-        query = "select client, start_ts, end_ts, status, duration, share, id, sync_status from events where client = '%s' and status = '%s' and sync_status = '%s' order by start_ts desc limit %d" % (client, status, sync_status, int(limit))
-    # SPECIFIC STATUS AND ALL CLIENTS
-    elif status != "ALL" and client == "ALL" and sync_status == "ALL":
-      query = "select client, start_ts, end_ts, status, duration, share, id, sync_status from events where status = '%s' order by start_ts desc limit %d" % (status, int(limit))
-    # SPECIFIC SYNC_STATUS AND ALL CLIENTS
-    elif sync_status != "ALL" and client == "ALL" and status == "ALL":
-        query = "select client, start_ts, end_ts, status, duration, share, id, sync_status from events where sync_status = '%s' order by start_ts desc limit %d" % (sync_status, int(limit))
-    # SPECIFIC SYNC_STATUS AND SPECIFIC STATUS
-    elif sync_status != "ALL" and client == "ALL" and status != "ALL":
-        query = "select client, start_ts, end_ts, status, duration, share, id, sync_status from events where sync_status = '%s' and status ='%s' order by start_ts desc limit %d" % (sync_status, status, int(limit))
-    #print ("Query %s" % query)
-    res = query_db(query)
+    # filters come from the form or, for the next page links, from the query string
+    filters = {}
+    for f in EventMgt.filters:
+      filters[f] = request.values.get(f)
+    since = date_ts(request.values.get('since'))
+    until = date_ts(request.values.get('until'))
+    if until is not None:
+      until += 86400
+    before = None
+    try:
+      limit = page_limit(request.values.get('limit'), 50)
+      if request.values.get('before_ts') and request.values.get('before_id'):
+        before = (int(request.values.get('before_ts')), int(request.values.get('before_id')))
+    except ValueError:
+      return jsonify("Bad limit or cursor"), 400
+    res = EventMgt().search(limit, since, until, before, **filters)
+    next_page = None
+    if len(res) == limit:
+      next_page = dict((k, v) for k, v in request.values.items() if k not in ('before_ts', 'before_id'))
+      next_page.update({'before_ts': res[-1][1], 'before_id': res[-1][6]})
     client = ClientMgt("all")
     clientlist = client.list_clients()
-    return render_template("events.html", events=res, clientlist=clientlist), 200
+    share = ShareMgt("all")
+    sharelist = share.share_list()
+    return render_template("events.html", events=res, clientlist=clientlist, sharelist=sharelist, next_page=next_page), 200
 
 
 @app.route("/events/<id>", methods=['GET'])
 @basic_auth.required
 def event_id(id):
-    query = "select count(id) from events where id=%d and status is not 'SYNCING'" % int(id)
-    if int(query_db(query)[0][0]) > 0:
-       query = "select id,client,status,log,start_ts,end_ts,duration,share from events where id=%d" % int(id)
-       res = query_db(query)
+    query = "select count(id) from events where id=? and status is not 'SYNCING'"
+    if int(query_db(query, (int(id),))[0][0]) > 0:
+       res = [EventMgt(int(id)).detail()]
        return render_template("event_log.html", event=res)
     else:
        return render_template("event_404.html", id=int(id)), 404
 
 ####  SYNC ENDPOINTS ####
 
+# sync event writes, grouped in one transaction per burst, see write_queue
+write_queue = WriteQueue(sync_write_mode)
+atexit.register(write_queue.flush)
+
+def sync_values():
+    """ /sync/start and /sync/end fields, from a form or a JSON body (gzip or deflate compressed)
+    :return: dict like, None if the JSON body is not valid
+    """
+    if request.mimetype == 'application/json':
+      values = decode_json(request.get_data(cache=False), request.headers.get('Content-Encoding'))
+      return values if isinstance(values, dict) else None
+    return request.form
+
 @app.route("/sync/start/<client>", methods=['PUT','POST'])
 def sync_start(client):
-    share = request.form.get('share')
-    start_ts = int(request.form.get('start_ts'))
+    values = sync_values()
+    if values is None:
+      return "Expected a JSON object", 400
+    share = values.get('share')
+    start_ts = int(values.get('start_ts'))
     clientmgt = ClientMgt(client)
     if clientmgt.exist()[0] == 0:
       return "Client %s does not exist, register first" % client, 500
     else:
-      clientmgt.check_pending()
       status = "SYNCING"
-      query = ("insert into events (client,start_ts,share,status) values ('%s',%d,'%s','%s')") % (client, start_ts, share, status)
-      #print (query)
-      query_db(query)
-      get_db().commit()
+      write_queue.write(clientmgt.sync_start, start_ts, share)
       return "Sync Started, record updated with status %s" % status, 200
 
 @app.route("/sync/end/<client>", methods=['PUT','POST'])
 def sync_end(client):
-    share = request.form.get('share')
-    start_ts = int(request.form.get('start_ts'))
-    status = request.form.get('status')
-    sync_status = request.form.get('sync_status')
-    log = request.form.get('log')
-    end_ts = int(request.form.get('end_ts'))
+    values = sync_values()
+    if values is None:
+      return "Expected a JSON object", 400
+    share = values.get('share')
+    start_ts = int(values.get('start_ts'))
+    status = values.get('status')
+    sync_status = values.get('sync_status')
+    log = values.get('log')
+    end_ts = int(values.get('end_ts'))
     duration = end_ts - start_ts
     clientmgt = ClientMgt(client)
     #print("%s : Log Sync Enc Received: %s" % (client, log) )
     if clientmgt.exist()[0] == 0:
       return "Client %s does not exist, register first" % client, 500
     else:
-      query = ("update events set status='%s', sync_status='%s', end_ts=%d, duration=%d, log='%s' where client='%s' and start_ts=%d") % (status, sync_status, end_ts, duration, log, client, start_ts)
-      query_db(query)
-      get_db().commit()
-      return "Sync Terminated, record updated with status %s, duration %d" % (status, duration) , 201
+      try:
+        metrics = EventMgt.parse_metrics(values)
+      except ValueError:
+        return "Sync metrics must be integers", 400
+      write_queue.write(EventMgt().end, client, start_ts, status, sync_status, end_ts, log, metrics)
+      headers = {}
+      hint = clientmgt.sync_hint(sync_interval_hint)
+      if hint is not None:
+        headers['X-Sync-Interval'] = str(hint)
+      return "Sync Terminated, record updated with status %s, duration %d" % (status, duration) , 201, headers
+
+@app.route("/sync/batch/<client>", methods=['PUT','POST'])
+def sync_batch(client):
+    events = decode_json(request.get_data(cache=False), request.headers.get('Content-Encoding'))
+    if not isinstance(events, list) or len(events) > sync_batch_max_events:
+      return jsonify("Expected a JSON array of at most %d events" % sync_batch_max_events), 400
+    clientmgt = ClientMgt(client)
+    if clientmgt.exist()[0] == 0:
+      return jsonify("Client %s does not exist, register first" % client), 500
+    try:
+      # the agent drops its spooled events on success, never acknowledge before the commit
+      recorded = write_queue.submit(EventMgt().record, client, events).wait(30)
+    except (KeyError, TypeError, ValueError, OverflowError, sqlite3.IntegrityError) as e:
+      return jsonify("Bad event in batch: %s" % e), 400
+    return jsonify({'recorded': recorded}), 201
 
 ############
 
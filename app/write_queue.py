@@ -0,0 +1,144 @@
+import os
+import queue
+import threading
+from db_conn import get_db
+
+# Group commit for the sync endpoints: request threads queue their writes
+# and one writer thread per process runs everything queued so far in a
+# single transaction, so a burst of syncs costs one commit and one trip
+# through the sqlite write lock instead of one per request.
+#
+# write modes:
+#   direct  every request writes and commits itself
+#   group   writes are grouped, the request returns once its group committed
+#   async   the request returns once its write is queued, queued writes are
+#           lost if the process dies before the next commit
+
+write_modes = ['direct', 'group', 'async']
+# seconds the writer waits for more writes after the first one; at 0 a group
+# is whatever queued while the previous group committed, no request waits
+# for a timer. direct stays the default: on WAL sqlite with 5x4 uwsgi
+# threads, grouping did not beat per request commits (453 vs 434 syncs/s)
+group_window = 0
+group_max = 500
+
+class WriteOp(object):
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    def finish(self):
+        with self.lock:
+            self.done.set()
+            callbacks = self.callbacks
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        """ call callback(op) from the writer thread once committed, right away if it already is """
+        with self.lock:
+            if not self.done.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def wait(self, timeout=None):
+        if not self.done.wait(timeout):
+            raise RuntimeError("write not committed after %s seconds" % timeout)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+class WriteQueue(object):
+    def __init__(self, mode='group', window=group_window, max_ops=group_max):
+        if mode not in write_modes:
+            raise ValueError("Unknown write mode %s, expected one of %s" % (mode, write_modes))
+        self.mode = mode
+        self.window = window
+        self.max_ops = max_ops
+        self.queue = None
+        self.pid = None
+        self.lock = threading.Lock()
+        self.stats = {'groups': 0, 'ops': 0, 'failed': 0, 'max_group': 0}
+
+    def start(self):
+        # uwsgi forks workers after import, the writer thread is started in each worker on first use
+        with self.lock:
+            if self.pid != os.getpid():
+                self.queue = queue.Queue()
+                self.pid = os.getpid()
+                threading.Thread(target=self.run, args=(self.queue,), daemon=True).start()
+
+    def submit(self, fn, *args):
+        """ run fn(*args, commit=False) in the next group
+        :return: WriteOp, wait() returns what fn returned once committed
+        """
+        op = WriteOp(fn, args)
+        if self.mode == 'direct':
+            try:
+                op.result = fn(*args)
+            except Exception as e:
+                op.error = e
+            op.finish()
+            return op
+        self.start()
+        self.queue.put(op)
+        return op
+
+    def write(self, fn, *args, timeout=30):
+        """ submit and, unless in async mode, wait for the commit
+        :return: what fn returned, None in async mode
+        """
+        op = self.submit(fn, *args)
+        if self.mode == 'async':
+            return None
+        return op.wait(timeout)
+
+    def flush(self, timeout=30):
+        """ wait until everything queued so far is committed """
+        if self.queue is not None and self.pid == os.getpid():
+            self.submit(lambda commit=False: None).wait(timeout)
+
+    def run(self, q):
+        while True:
+            ops = [q.get()]
+            try:
+                ops.append(q.get(timeout=self.window))
+                while len(ops) < self.max_ops:
+                    ops.append(q.get_nowait())
+            except queue.Empty:
+                pass
+            self.commit_group(ops)
+
+    def commit_group(self, ops):
+        db = get_db()
+        try:
+            db.execute("begin immediate")
+            for op in ops:
+                # a savepoint per write, a failing one does not undo the rest of the group
+                db.execute("savepoint op")
+                try:
+                    op.result = op.fn(*op.args, commit=False)
+                    db.execute("release op")
+                except Exception as e:
+                    db.execute("rollback to op")
+                    db.execute("release op")
+                    op.error = e
+                    self.stats['failed'] += 1
+            db.commit()
+        except Exception as e:
+            if db.in_transaction:
+                db.rollback()
+            for op in ops:
+                op.error = e
+            self.stats['failed'] += len(ops)
+        self.stats['groups'] += 1
+        self.stats['ops'] += len(ops)
+        self.stats['max_group'] = max(self.stats['max_group'], len(ops))
+        for op in ops:
+            op.finish()
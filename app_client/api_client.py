@@ -0,0 +1,53 @@
+import gzip
+import json
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# One long lived HTTP client for the sync API: the pooled Session keeps the
+# TCP (and TLS) connection alive between syncs, every request has a
+# timeout, and failed requests are retried a few times with backoff before
+# the agent gives up on the cycle. /sync/start is a no-op when the server
+# already has the sync, so POSTs are retried too.
+#
+# Bodies are JSON, gzip compressed above compress_min bytes: the unison
+# log is the bulk of /sync/end and compresses ~10x.
+
+class ApiClient(object):
+    def __init__(self, protocol, hostname, port, client, timeout=30, retries=3, compress_min=1024):
+      self.base_url = "%s://%s:%s" % (protocol, hostname, port)
+      self.client = client
+      # connect fast, leave the server time to commit the sync
+      self.timeout = (5, float(timeout))
+      self.compress_min = compress_min
+      retry = Retry(total=int(retries), backoff_factor=1, status_forcelist=(502, 503, 504),
+                    allowed_methods=None, raise_on_status=False)
+      self.session = requests.Session()
+      adapter = HTTPAdapter(max_retries=retry, pool_connections=1, pool_maxsize=2)
+      self.session.mount("http://", adapter)
+      self.session.mount("https://", adapter)
+
+    def post_json(self, path, data):
+      """ POST data as JSON
+      :return: requests Response, raises requests.RequestException once the retries are exhausted
+      """
+      body = json.dumps(data).encode('utf-8')
+      headers = {'Content-Type': 'application/json'}
+      if len(body) >= self.compress_min:
+        body = gzip.compress(body, 6)
+        headers['Content-Encoding'] = 'gzip'
+      return self.session.post(self.base_url + path, data=body, headers=headers, timeout=self.timeout)
+
+    def sync_start(self, share, start_ts):
+      return self.post_json("/sync/start/" + self.client, {'share': share, 'start_ts': start_ts})
+
+    def sync_end(self, data):
+      """ :param data: share, start_ts, end_ts, status, sync_status, log and the sync metrics """
+      return self.post_json("/sync/end/" + self.client, data)
+
+    def sync_batch(self, events):
+      """ :param events: finished syncs, as sync_end data """
+      return self.post_json("/sync/batch/" + self.client, events)
+
+    def close(self):
+      self.session.close()
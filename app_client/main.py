@@ -1,75 +1,129 @@
 import time
+import json
 import requests
 import os
 import sys
 from time import sleep,strftime
 from conf import *
-from shell import ShellCmd
+from shell import StreamCmd
 from log import Log
+from scheduler import SyncScheduler
+from unison_result import UnisonResult
+from api_client import ApiClient
+from spool import Spool
+from watcher import make_watcher
 
 root_dir         = "/data"
 #root_dir         = "./data"
 log_dir          = root_dir + "/log"
 logfile          = log_dir + "/client.log"
 lockfile         = log_dir + "/client.lock"
+progressfile     = log_dir + "/client.progress"
+spoolfile        = log_dir + "/client.spool"
+progress_every   = 5
+progress_ts      = 0
 command          = "unison unicloud"
 #command          = "sleep 10"
 
 start_sync_url      = server_api_protocol + "://" +  server_hostname + ":" + server_api_port + "/sync/start/" + client_hostname
-end_sync_url        = server_api_protocol + "://" +  server_hostname + ":" + server_api_port + "/sync/end/" + client_hostname
 share_exist_url     = server_api_protocol + "://" +  server_hostname + ":" + server_api_port + "/shares/exist"
 
+api = ApiClient(server_api_protocol, server_hostname, server_api_port, client_hostname, api_timeout, api_retries)
+spool = Spool(spoolfile)
+
 def get_ts():
   ts = int(time.time())
   return ts
 
-def start_sync(log):
-  #result[0]pid result[1]rc result[2]status result[3]log result[4]sync_status
+def write_progress(run, line, force=False):
+  # live sync progress for docker exec / monitoring, rewritten at most every progress_every seconds
+  global progress_ts
+  if force or time.time() - progress_ts >= progress_every:
+    progress_ts = time.time()
+    with open(progressfile + ".tmp", "w") as f:
+      json.dump(run.progress(), f)
+    os.replace(progressfile + ".tmp", progressfile)
+
+def start_sync(log, offline=False):
+  #result[0]pid result[1]rc result[2]status result[3]log result[4]sync_status result[5]metrics result[6]offline
+  # offline: the API is known to be down, do not wait on it again
   log.header()
   log.sync_start()
   result = []
-  match=['BGN','END','Nothing','Complete']
-  data = {'share':server_share, 'start_ts': start_ts }
-  try:
-    r = requests.post(url = start_sync_url, data = data)
-  except requests.ConnectionError:
-    return 6
-  else:
-    if r.status_code == 200:
-      run = ShellCmd(command)
-      result.insert(0, run.getpid())
-      result.insert(1, run.getrc())
-      #print (run)
-      if run.getrc() == 0:
-        result.insert(2, 'OK')
-      elif run.getrc() == 1 or run.getrc() == 2:
-        result.insert(2, 'WARNING')
-      else:
-        result.insert(2, 'KO')
-      unisonstderr=run.rstderr()
-      result.insert(3, unisonstderr)
-      if "Nothing to do" in unisonstderr:
-        result.insert(4, "UNCHANGED")
-      elif "Synchronization complete" in unisonstderr:
-        result.insert(4, "CHANGED")
-      elif "Synchronization incomplete" in unisonstderr:
-        result.insert(4, "WARNING")
-      else:
-        result.insert(4, "UNKNOWN")
+  r = None
+  if not offline:
+    try:
+      r = api.sync_start(server_share, start_ts)
+    except requests.RequestException:
+      offline = True
+  # unison goes over ssh, not through the API: sync anyway when offline, the report is spooled
+  if offline or r.status_code == 200:
+    parser = UnisonResult(client_dest)
+    def on_line(run, line):
+      parser.feed(line)
+      write_progress(run, line)
+    if watcher is not None:
+      # edits from now on may be missed by this run, they trigger the next one
+      watcher.drain()
+    run = StreamCmd(command, on_line=on_line).run()
+    write_progress(run, None, force=True)
+    if watcher is not None and watcher.after_sync(parser.paths):
+      print ("Local changes during the sync, syncing again")
+    result.insert(0, run.getpid())
+    result.insert(1, run.getrc())
+    #print (run)
+    if run.getrc() == 0:
+      result.insert(2, 'OK')
+    elif run.getrc() == 1 or run.getrc() == 2:
+      result.insert(2, 'WARNING')
     else:
-      result.insert(0, 0)
-      result.insert(1, 0)
-      result.insert(2, "ERROR")
-      result.insert(3, "Connection Error")
-      result.insert(4, "UNKNOWN")
+      result.insert(2, 'KO')
+    unisonstderr=run.rstderr()
+    result.insert(3, unisonstderr)
+    result.insert(4, parser.sync_status)
+    result.insert(5, parser.metrics())
+  else:
+    result.insert(0, 0)
+    result.insert(1, 0)
+    result.insert(2, "ERROR")
+    result.insert(3, "Connection Error")
+    result.insert(4, "UNKNOWN")
+    result.insert(5, {})
+  result.insert(6, offline)
   return result
   
 def end_sync(result,log):
+  # return the server hint on when to sync next, None without one, 6 if the API is unreachable and the report was spooled
   data = {'share':server_share, 'start_ts':start_ts, 'end_ts':int(time.time()), 'status':result[2], 'log':result[3], 'sync_status':result[4] }
-  r = requests.post(url = end_sync_url, data = data)
-  #log.client_error("Log received : %s" % result[3])
+  data.update(result[5])
   log.sync_end(result)
   log.header()
+  if result[6]:
+    # the server never saw the start, the batch endpoint records the whole sync
+    spool.append(data)
+    return 6
+  try:
+    r = api.sync_end(data)
+  except requests.RequestException:
+    r = None
+  if r is None or r.status_code >= 502:
+    spool.append(data)
+    return 6
+  #log.client_error("Log received : %s" % result[3])
+  return r.headers.get('X-Sync-Interval')
+
+def flush_spool():
+  # reports spooled while the API was down, sent before the next sync so they stay in order
+  # return False if the API is unreachable
+  if not os.path.exists(spoolfile):
+    return True
+  try:
+    sent = spool.flush(api)
+  except requests.RequestException:
+    return False
+  if sent:
+    print ("%d spooled sync reports sent, %d left" % (sent, len(spool)))
+  return True
 
 def start_lock(lockfile):
   filevar = open(lockfile,"w")
@@ -86,26 +140,38 @@ def remove_lock(lockfile,filevar):
 if os.path.exists(lockfile):
   os.remove(lockfile)
 
+scheduler = SyncScheduler(int(sync_interval), int(sync_interval_min), int(sync_interval_max), float(sync_jitter))
+watcher = make_watcher(watch_mode, client_dest, share_ignore.split("|"), float(watch_debounce), int(watch_poll_interval))
+sleep(scheduler.first_delay())
+
 # THE WHILE LOOP
 
 while True:
   if not os.path.exists(lockfile):
     log=Log(logfile)
     filevar = start_lock(lockfile)
+    online = flush_spool()
     start_ts = get_ts()
-    result = start_sync(log)
+    result = start_sync(log, offline=not online)
     #print (result)
-    if result == 6 or result == 503:
-      log.client_error("Client %s can't contact API Server [ %s ]" % (client_hostname, start_sync_url) )
-    elif result == 500:
-      log.client_error("Client %s is not enabled, enable it from server UI" % client_hostname)
+    hint = end_sync(result,log)
+    if hint == 6:
+      # back off while the API is down, whatever unison did
+      log.client_error("Client %s can't contact API Server [ %s ], sync report spooled [ %s ]" % (client_hostname, start_sync_url, spoolfile))
+      scheduler.sync_failed()
     else:
-      end_sync(result,log)
+      scheduler.sync_done(result[4], hint)
     remove_lock(lockfile,filevar)
   else:
     print ("Lock File exist, wait")
   log.close()
-  sleep(int(sync_interval))
+  delay = scheduler.next_delay()
+  print ("Next sync in %ds (%s)" % (delay, scheduler))
+  if watcher is None or scheduler.failures:
+    sleep(delay)
+  else:
+    if watcher.wait(delay):
+      print ("Local changes, syncing now")
 
 
 
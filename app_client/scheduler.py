@@ -0,0 +1,68 @@
+import random
+
+# When to run the next sync. Agents started together would otherwise stay
+# phase locked and hit the server, sshd and unison at the same instant:
+# every delay is jittered, the first one spreads the agents over a whole
+# interval. The interval grows after a streak of UNCHANGED syncs, shrinks
+# after a CHANGED one, and backs off exponentially while the API is
+# unreachable. A server hint (X-Sync-Interval) caps the adaptive interval,
+# the server sends it so clients with a sync threshold stay In Sync.
+
+class SyncScheduler(object):
+    def __init__(self, interval, min_interval, max_interval, jitter=0.2, unchanged_after=3, max_backoff=3600):
+      self.base = interval
+      self.min_interval = min(min_interval, interval)
+      self.max_interval = max(max_interval, interval)
+      self.jitter = jitter
+      self.unchanged_after = unchanged_after
+      self.max_backoff = max_backoff
+      self.interval = interval
+      self.unchanged = 0
+      self.failures = 0
+      self.hint = None
+
+    def spread(self, delay):
+      return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def first_delay(self):
+      """ random start within one interval """
+      return random.uniform(0, self.base)
+
+    def sync_done(self, sync_status, hint=None):
+      """ record a finished sync
+      :param sync_status: CHANGED, UNCHANGED, WARNING or UNKNOWN
+      :param hint: X-Sync-Interval returned by the server, None if absent
+      """
+      self.failures = 0
+      if sync_status == "CHANGED":
+        self.unchanged = 0
+        # a share that changes goes back below the base interval at once
+        self.interval = max(self.min_interval, min(self.interval, self.base) / 2)
+      elif sync_status == "UNCHANGED":
+        self.unchanged += 1
+        if self.unchanged >= self.unchanged_after:
+          self.interval = min(self.max_interval, self.interval * 1.5)
+      else:
+        self.unchanged = 0
+        self.interval = self.base
+      try:
+        self.hint = int(hint) if hint is not None and int(hint) > 0 else None
+      except ValueError:
+        self.hint = None
+
+    def sync_failed(self):
+      """ record a sync that could not reach the API """
+      self.failures += 1
+
+    def next_delay(self):
+      """ seconds to wait before the next sync """
+      if self.failures:
+        # retry fast after a blip, then double up to max_backoff
+        backoff = min(self.max_backoff, min(self.base, 30) * 2 ** (self.failures - 1))
+        return random.uniform(backoff / 2, backoff)
+      if self.hint is not None:
+        return self.spread(min(self.interval, self.hint))
+      return self.spread(self.interval)
+
+    def __repr__(self):
+      return "interval %ds, unchanged %d, failures %d, hint %s" % (self.interval, self.unchanged, self.failures, self.hint)
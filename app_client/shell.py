@@ -1,13 +1,12 @@
 import subprocess
+import threading
+import time
+from collections import deque
 
 class ShellCmd(object):
-    output={}
-    output_stderr=[]
-    output_lines=[]
-    rc=0
-    pid=0
     def __init__(self,cmd):
       self.cmd  = cmd
+      self.output_lines=[]
       out = subprocess.Popen([cmd],
         shell=True,
         stdout=subprocess.PIPE,
@@ -16,6 +15,7 @@ class ShellCmd(object):
       self.output = stdout.decode()[:-1]
       self.rc=out.returncode
       self.pid=out.pid
+      self.output_stderr = ""
       if stderr is not None:
         self.output_stderr = stderr.decode()[:-1]
       #print (self.output)
@@ -39,6 +39,77 @@ class ShellCmd(object):
             i += 1
         return self.filter
 
+# unison lines worth keeping whatever the tail size
+result_marks = ['Nothing to do', 'Synchronization complete', 'Synchronization incomplete', 'Fatal error']
 
+class StreamCmd(object):
+    """ run cmd reading its output as it comes, memory stays bounded whatever unison prints:
+    only the last tail_lines lines of stderr are kept for the sync log, plus the result lines
+    :param on_line: called as on_line(cmd, line) for every stderr line, for live progress
+    """
+    def __init__(self, cmd, tail_lines=500, max_line=4096, on_line=None):
+      self.cmd = cmd
+      self.tail = deque(maxlen=tail_lines)
+      self.stdout_tail = deque(maxlen=tail_lines)
+      self.max_line = max_line
+      self.on_line = on_line
+      self.lines = 0
+      self.started = 0
+      self.finished = 0
+      self.last_line = ""
+      self.result_lines = []
+      self.transfers = 0
+      self.rc = None
+      self.pid = 0
 
+    def run(self):
+      self.started = time.time()
+      proc = subprocess.Popen([self.cmd],
+        shell=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        errors='replace')
+      self.pid = proc.pid
+      # stdout is drained aside so a full pipe never blocks unison
+      drain = threading.Thread(target=self.read_stdout, args=(proc.stdout,), daemon=True)
+      drain.start()
+      for line in proc.stderr:
+        self.add_line(line.rstrip('\n')[:self.max_line])
+      drain.join()
+      self.rc = proc.wait()
+      self.finished = time.time()
+      return self
+
+    def read_stdout(self, pipe):
+      for line in pipe:
+        self.stdout_tail.append(line.rstrip('\n')[:self.max_line])
 
+    def add_line(self, line):
+      self.lines += 1
+      self.last_line = line
+      self.tail.append(line)
+      if line.startswith('[END]'):
+        self.transfers += 1
+      if any(mark in line for mark in result_marks):
+        self.result_lines.append(line)
+        del self.result_lines[:-10]
+      if self.on_line is not None:
+        self.on_line(self, line)
+
+    def progress(self):
+      return {'pid': self.pid, 'lines': self.lines, 'transfers': self.transfers,
+              'elapsed': round((self.finished or time.time()) - self.started, 1), 'last': self.last_line}
+
+    def __repr__(self):
+      return "\n".join(self.stdout_tail)
+    def rstderr(self):
+      """ log tail, with the result lines that scrolled out of it """
+      lines = [line for line in self.result_lines if line not in self.tail]
+      if self.lines > len(self.tail):
+        lines.append("[... %d lines not kept ...]" % (self.lines - len(self.tail)))
+      return "\n".join(lines + list(self.tail))
+    def getrc(self):
+      return self.rc
+    def getpid(self):
+      return self.pid
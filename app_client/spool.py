@@ -0,0 +1,100 @@
+import json
+import os
+
+# Sync reports the API could not take, one JSON line each, appended and
+# fsync-ed so a restart of the agent does not lose them. They are sent
+# back with /sync/batch once the API answers again, batch_size reports per
+# request, oldest first; the server stores a report it already has only
+# once, so a batch resent after a crash is harmless. A batch the server
+# refuses is split until the report at fault is found and dropped. Beyond
+# max_reports the oldest reports are dropped.
+
+class Spool(object):
+    def __init__(self, path, max_reports=1000, batch_size=50, batch_bytes=8 * 1024 * 1024):
+      self.path = path
+      self.max_reports = max_reports
+      self.batch_size = batch_size
+      self.batch_bytes = batch_bytes
+
+    def append(self, report):
+      with open(self.path, "a") as f:
+        f.write(json.dumps(report) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+    def reports(self):
+      """ spooled reports, oldest first, a line cut by a crash is skipped """
+      if not os.path.exists(self.path):
+        return []
+      result = []
+      with open(self.path) as f:
+        for line in f:
+          try:
+            result.append(json.loads(line))
+          except ValueError:
+            pass
+      return result[-self.max_reports:]
+
+    def rewrite(self, reports):
+      if not reports:
+        os.remove(self.path)
+        return
+      with open(self.path + ".tmp", "w") as f:
+        for report in reports:
+          f.write(json.dumps(report) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+      os.replace(self.path + ".tmp", self.path)
+
+    def batches(self, reports):
+      batch, size = [], 0
+      for report in reports:
+        length = len(report.get('log') or '')
+        if batch and (len(batch) == self.batch_size or size + length > self.batch_bytes):
+          yield batch
+          batch, size = [], 0
+        batch.append(report)
+        size += length
+      if batch:
+        yield batch
+
+    def send(self, api, batch):
+      """ send batch, split in halves when the server refuses it (400) or finds it too large (413),
+      so only the reports it will never take are dropped
+      :return: (number of reports sent or dropped from the start of batch, False to stop and retry later)
+      """
+      r = api.sync_batch(batch)
+      if r.status_code == 201:
+        return len(batch), True
+      if r.status_code >= 500 or r.status_code in (408, 429):
+        # the server is down or busy, keep the reports for the next flush
+        return 0, False
+      if len(batch) == 1:
+        print ("Spooled report of %s rejected (%d): %s" % (batch[0].get('start_ts'), r.status_code, r.text))
+        return 1, True
+      half = len(batch) // 2
+      done, go_on = self.send(api, batch[:half])
+      if not go_on:
+        return done, False
+      more, go_on = self.send(api, batch[half:])
+      return done + more, go_on
+
+    def flush(self, api):
+      """ send the spooled reports, stop at the first batch the API cannot take now
+      :return: number of reports sent or dropped, raises requests.RequestException if the API is unreachable
+      """
+      reports = self.reports()
+      sent = 0
+      try:
+        for batch in self.batches(reports):
+          done, go_on = self.send(api, batch)
+          sent += done
+          if not go_on:
+            break
+      finally:
+        if sent or len(reports) == self.max_reports:
+          self.rewrite(reports[sent:])
+      return sent
+
+    def __len__(self):
+      return len(self.reports())
@@ -0,0 +1,78 @@
+import os
+import re
+import stat
+
+# Parse unison text output as it streams (feed it every stderr line) into
+# the sync status and file change counts sent to /sync/end.
+#
+#   [END] Copying path                                  one transfer done
+#   [CONFLICT] Skipping path                            one conflict
+#   failed: path                                        one failure
+#   Nothing to do: replicas have not changed since last sync.
+#   Synchronization complete at 10:00:00  (3 items transferred, 1 skipped, 0 failed)
+#
+# A conflict is also listed as "changed <-?-> changed path" while
+# reconciling, only the [CONFLICT] line of propagation counts it.
+# The summary line, when present, wins over the per line counts. unison
+# does not report bytes in batch mode: the bytes moved are the sizes of
+# the copied files, stat-ed in the local replica as each copy ends. The
+# paths of the [END] lines are kept for the watcher, up to max_paths.
+
+summary_re = re.compile(r"Synchronization (complete|incomplete) at .*\((\d+) items? transferred, (\d+) skipped, (\d+) failed\)")
+end_re = re.compile(r"^\[END\] (Copying|Updating file|Deleting|Copying properties for) (.*)$")
+max_paths = 100000
+
+class UnisonResult(object):
+    def __init__(self, replica):
+      self.replica = replica
+      self.sync_status = "UNKNOWN"
+      self.transferred = 0
+      self.skipped = 0
+      self.failed = 0
+      self.conflicts = 0
+      self.bytes = 0
+      self.summary = False
+      # paths written by unison, None once more than max_paths
+      self.paths = set()
+
+    def feed(self, line):
+      m = end_re.match(line)
+      if m:
+        if not self.summary:
+          self.transferred += 1
+        if self.paths is not None:
+          self.paths.add(m.group(2).strip())
+          if len(self.paths) > max_paths:
+            self.paths = None
+        if m.group(1) in ("Copying", "Updating file"):
+          self.add_bytes(m.group(2).strip())
+        return
+      if line.startswith("[CONFLICT]"):
+        self.conflicts += 1
+      elif line.lstrip().startswith("failed:") and not self.summary:
+        self.failed += 1
+      elif line.startswith("Nothing to do"):
+        self.sync_status = "UNCHANGED"
+      m = summary_re.search(line)
+      if m:
+        self.summary = True
+        self.sync_status = "CHANGED" if m.group(1) == "complete" else "WARNING"
+        self.transferred, self.skipped, self.failed = int(m.group(2)), int(m.group(3)), int(m.group(4))
+
+    def add_bytes(self, path):
+      try:
+        st = os.lstat(os.path.join(self.replica, path))
+      except OSError:
+        # removed or renamed since
+        return
+      if stat.S_ISREG(st.st_mode):
+        self.bytes += st.st_size
+
+    def metrics(self):
+      """ event columns sent to /sync/end """
+      return {'files_transferred': self.transferred, 'files_skipped': self.skipped, 'files_failed': self.failed,
+              'conflicts': self.conflicts, 'bytes_transferred': self.bytes}
+
+    def __repr__(self):
+      return "%s, %d transferred, %d skipped, %d failed, %d conflicts, %d bytes" % (
+        self.sync_status, self.transferred, self.skipped, self.failed, self.conflicts, self.bytes)
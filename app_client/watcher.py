@@ -0,0 +1,257 @@
+import ctypes
+import errno
+import fnmatch
+import os
+import select
+import struct
+import time
+
+# Wait for local changes under the synced folder, so a sync starts soon
+# after an edit instead of at the next timer tick, and an idle folder is
+# not rescanned by unison every interval (the scheduler interval stays the
+# safety net, for changes made on the server).
+#
+# InotifyWatcher calls the kernel inotify API through ctypes, one watch
+# per directory. PollWatcher compares a stat snapshot of the tree every
+# poll_interval seconds, for kernels or volumes without inotify (network
+# and some bind mounts) or when the watch limit is reached.
+#
+# A sync writes into the folder too. After a run, after_sync forgets the
+# changes on the paths unison reported, so only edits made elsewhere
+# meanwhile start another run. InotifyWatcher knows the changed paths (up
+# to max_changed, then any change counts); PollWatcher does not, its
+# changes made during a run wait for the interval.
+
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR       = 0x40000000
+
+watch_mask = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+event_header = struct.Struct("iIII")
+
+# unison temporary files, written by the sync itself
+unison_tmp = ".unison.*"
+max_changed = 10000
+
+class WatchError(Exception):
+    pass
+
+class Watcher(object):
+    def __init__(self, root, ignore=None, debounce=2):
+      self.root = root
+      self.ignore = [p for p in (ignore or []) if p] + [unison_tmp]
+      self.debounce = debounce
+      # a folder written without pause still gets synced
+      self.max_debounce = debounce * 10
+      # changes left by after_sync, the next wait returns once they settle
+      self.pending = False
+
+    def ignored(self, name):
+      return any(fnmatch.fnmatch(name, p) for p in self.ignore)
+
+    def drain(self):
+      """ forget the changes seen so far, called right before unison scans the folder """
+      pass
+
+    def after_sync(self, synced):
+      """ forget the changes made by the sync, called once unison exited
+      :param synced: paths unison wrote, relative to root, None if unknown
+      :return: True if other changes are pending
+      """
+      return False
+
+    def close(self):
+      pass
+
+class InotifyWatcher(Watcher):
+    def __init__(self, root, ignore=None, debounce=2):
+      Watcher.__init__(self, root, ignore, debounce)
+      # CDLL(None) finds inotify in glibc and in musl (alpine)
+      libc = ctypes.CDLL(None, use_errno=True)
+      if not hasattr(libc, "inotify_init1"):
+        raise WatchError("inotify not available")
+      self.libc = libc
+      self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+      if self.fd < 0:
+        raise WatchError("inotify_init1: %s" % os.strerror(ctypes.get_errno()))
+      self.watches = {}
+      # paths changed since the last drain, relative to root, None once more than max_changed
+      self.changed = set()
+      try:
+        self.add_tree(root)
+      except WatchError:
+        self.close()
+        raise
+
+    def add_watch(self, path):
+      wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), watch_mask)
+      if wd < 0:
+        err = ctypes.get_errno()
+        if err in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+          # gone or unreadable since listed
+          return
+        # ENOSPC: fs.inotify.max_user_watches reached
+        raise WatchError("inotify_add_watch %s: %s" % (path, os.strerror(err)))
+      self.watches[wd] = path
+
+    def add_tree(self, top):
+      self.add_watch(top)
+      for path, dirs, files in os.walk(top):
+        dirs[:] = [d for d in dirs if not self.ignored(d)]
+        for d in dirs:
+          self.add_watch(os.path.join(path, d))
+
+    def read_events(self):
+      """ :return: True if one of the pending events is a change worth a sync """
+      changed = False
+      while True:
+        try:
+          data = os.read(self.fd, 65536)
+        except BlockingIOError:
+          return changed
+        offset = 0
+        while offset < len(data):
+          wd, mask, cookie, length = event_header.unpack_from(data, offset)
+          name = data[offset + event_header.size:offset + event_header.size + length].split(b"\0", 1)[0]
+          offset += event_header.size + length
+          if mask & IN_Q_OVERFLOW:
+            changed = True
+            self.changed = None
+            continue
+          if mask & IN_IGNORED:
+            self.watches.pop(wd, None)
+            continue
+          name = os.fsdecode(name)
+          if name and self.ignored(name):
+            continue
+          changed = True
+          if self.changed is not None and wd in self.watches:
+            self.changed.add(os.path.relpath(os.path.join(self.watches[wd], name), self.root))
+            if len(self.changed) > max_changed:
+              self.changed = None
+          if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and wd in self.watches:
+            try:
+              self.add_tree(os.path.join(self.watches[wd], name))
+            except WatchError as e:
+              # changes below it are left to the periodic sync
+              print ("Inotify watch failed: %s" % e)
+
+    def wait(self, timeout):
+      """ block until a change settled (no new one for debounce seconds) or timeout
+      :return: True on change, False on timeout
+      """
+      deadline = time.time() + timeout
+      first = time.time() if self.pending else None
+      self.pending = False
+      while True:
+        now = time.time()
+        if first is None:
+          left = deadline - now
+        else:
+          left = min(self.debounce, first + self.max_debounce - now)
+        if left <= 0:
+          return first is not None
+        ready, _, _ = select.select([self.fd], [], [], left)
+        if not ready:
+          if first is not None:
+            # quiet for debounce seconds
+            return True
+          continue
+        if self.read_events() and first is None:
+          first = time.time()
+
+    def drain(self):
+      self.read_events()
+      self.changed = set()
+
+    def after_sync(self, synced):
+      self.read_events()
+      if self.changed is None or synced is None:
+        self.pending = self.changed != set()
+      else:
+        self.pending = any(not self.covered(path, synced) for path in self.changed)
+      self.changed = set()
+      return self.pending
+
+    def covered(self, path, synced):
+      """ True if unison wrote path or one of its parents (a copied directory is one [END] line) """
+      while path not in ('', '.'):
+        if path in synced:
+          return True
+        path = os.path.dirname(path)
+      return False
+
+    def close(self):
+      if self.fd >= 0:
+        os.close(self.fd)
+        self.fd = -1
+
+class PollWatcher(Watcher):
+    def __init__(self, root, ignore=None, debounce=2, poll_interval=30):
+      Watcher.__init__(self, root, ignore, debounce)
+      self.poll_interval = poll_interval
+      self.state = self.snapshot()
+
+    def snapshot(self):
+      """ hash of name, size and mtime of every entry, nothing kept per file """
+      h = 0
+      for path, dirs, files in os.walk(self.root):
+        dirs[:] = [d for d in dirs if not self.ignored(d)]
+        for name in dirs + files:
+          if self.ignored(name):
+            continue
+          try:
+            st = os.lstat(os.path.join(path, name))
+          except OSError:
+            continue
+          h ^= hash((path, name, st.st_size, st.st_mtime_ns, st.st_mode))
+      return h
+
+    def wait(self, timeout):
+      """ see InotifyWatcher.wait, changes are seen poll_interval seconds late at most """
+      deadline = time.time() + timeout
+      while True:
+        left = deadline - time.time()
+        if left <= 0:
+          return False
+        time.sleep(min(self.poll_interval, left))
+        state = self.snapshot()
+        if state != self.state:
+          self.state = state
+          # wait for the writes to settle
+          time.sleep(self.debounce)
+          self.state = self.snapshot()
+          return True
+
+    def drain(self):
+      self.state = self.snapshot()
+
+    def after_sync(self, synced):
+      self.state = self.snapshot()
+      return False
+
+def make_watcher(mode, root, ignore=None, debounce=2, poll_interval=30):
+    """ :param mode: inotify (poll when inotify fails), poll or off
+    :return: a Watcher, None in off mode
+    """
+    if mode == "inotify":
+      try:
+        return InotifyWatcher(root, ignore, debounce)
+      except WatchError as e:
+        print ("Inotify watch failed (%s), polling every %ds" % (e, poll_interval))
+        mode = "poll"
+    if mode == "poll":
+      return PollWatcher(root, ignore, debounce, poll_interval)
+    return None
@@ -112,6 +112,14 @@ def conf_supervisord():
        svcfg.write("user=%s" % user + nl)
        svcfg.write("directory=/usr/local/unicloud" + nl)
        svcfg.write("command=/usr/bin/uwsgi --ini %s" % uwsgi_ini + nl)
+       if str(async_api).lower() == "true":
+         svcfg.write("[program:unicloud_api]" + nl)
+         svcfg.write("user=%s" % user + nl)
+         svcfg.write("autorestart=true" + nl)
+         svcfg.write("directory=/usr/local/unicloud" + nl)
+         svcfg.write("command=python3 async_api.py" + nl)
+         svcfg.write("stdout_logfile = %s/unicloud-api.log" % log_dir + nl)
+         svcfg.write("redirect_stderr=true" + nl)
   else:
      # CLIENT CONFIG
      with open(supervise_cfg, 'a') as svcfg:
@@ -156,11 +164,20 @@ def client_conf():
       cfg.write("user_uid='%s'" % user_uid + nl)
       cfg.write("server_hostname='%s'" % server_hostname + nl)
       cfg.write("server_share='%s'" % server_share + nl)
+      cfg.write("client_dest='%s'" % client_dest + nl)
       cfg.write("share_ignore='%s'" % share_ignore + nl)
       cfg.write("unison_params='%s'" % unison_params + nl)
       cfg.write("sync_interval='%s'" % sync_interval + nl)
+      cfg.write("sync_interval_min='%s'" % sync_interval_min + nl)
+      cfg.write("sync_interval_max='%s'" % sync_interval_max + nl)
+      cfg.write("sync_jitter='%s'" % sync_jitter + nl)
+      cfg.write("watch_mode='%s'" % watch_mode + nl)
+      cfg.write("watch_debounce='%s'" % watch_debounce + nl)
+      cfg.write("watch_poll_interval='%s'" % watch_poll_interval + nl)
       cfg.write("server_api_port='%s'" % server_api_port + nl)
       cfg.write("server_api_protocol='%s'" % server_api_protocol + nl)
+      cfg.write("api_timeout='%s'" % api_timeout + nl)
+      cfg.write("api_retries='%s'" % api_retries + nl)
     print ("Creating unison profile")
     share_path = get_share_path()
     with open(unison_prf, 'w') as cfg:
@@ -201,6 +218,7 @@ def server_conf():
        cfg.write("module = wsgi:app" + nl)
        cfg.write("master = true" + nl)
        cfg.write("processes = 5" + nl)
+       cfg.write("threads = 4" + nl)
        cfg.write("enable-threads = true" + nl)
        cfg.write("socket = unicloud.sock" + nl)
        cfg.write("chmod-socket = 664" + nl)
@@ -218,12 +236,23 @@ def server_conf():
        cfg.write("server_ui_password='%s'" % server_ui_password + nl)
        cfg.write("server_debug=%s" % server_debug + nl)
        cfg.write("shares_path='%s'" % shares_path + nl)
+       cfg.write("files_accel_redirect=%s" % files_accel_redirect + nl)
+       cfg.write("sync_write_mode='%s'" % sync_write_mode + nl)
+       cfg.write("sync_interval_hint='%s'" % sync_interval_hint + nl)
        cfg.write("max_log_events='%s'" % max_log_events + nl)
+       cfg.write("max_log_days='%s'" % max_log_days + nl)
+       cfg.write("max_client_logs='%s'" % max_client_logs + nl)
+       cfg.write("rollup_days='%s'" % rollup_days + nl)
+       cfg.write("rollup_daily_days='%s'" % rollup_daily_days + nl)
      print ("Set App Permission..")
      ShellCmd("chown -R %s:%s %s" % (user, user, server_app_dir))
      print ("Configure nginx with %s user.." % user)
      ShellCmd("sed -i 's/user nginx;/user %s;/g' /etc/nginx/nginx.conf" % user)
      ShellCmd("sed -i 's/\/var\/log\/nginx\/access.log/\/data\/log\/access.log/g' /etc/nginx/nginx.conf")
+     ShellCmd("sed -i 's|alias /shares/;|alias %s/;|g' /etc/nginx/conf.d/default.conf" % shares_path.rstrip('/'))
+     if str(async_api).lower() == "true":
+       print ("Route agents API to async server..")
+       ShellCmd("sed -i 's/#async_api //g' /etc/nginx/conf.d/default.conf")
 
 
 def exit_screen(status, error="None"):
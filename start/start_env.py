@@ -12,12 +12,28 @@ server_hostname      = os.getenv('SERVER_HOSTNAME')
 server_port          = os.getenv('SERVER_PORT', 22)
 server_share         = os.getenv('SERVER_SHARE')
 max_log_events       = os.getenv('MAX_LOG_EVENTS', 5000)
+max_log_days         = os.getenv('MAX_LOG_DAYS', 0)
+max_client_logs      = os.getenv('MAX_CLIENT_LOG_EVENTS', 0)
+rollup_days          = os.getenv('ROLLUP_DAYS', 0)
+rollup_daily_days    = os.getenv('ROLLUP_DAILY_DAYS', 0)
 share_ignore         = os.getenv('SHARE_IGNORE', '.unison')
 sync_interval        = os.getenv('SYNC_INTERVAL', 300)
+sync_interval_min    = os.getenv('SYNC_INTERVAL_MIN', 60)
+sync_interval_max    = os.getenv('SYNC_INTERVAL_MAX', 3600)
+sync_jitter          = os.getenv('SYNC_JITTER', 0.2)
+watch_mode           = os.getenv('WATCH', 'inotify')
+watch_debounce       = os.getenv('WATCH_DEBOUNCE', 2)
+watch_poll_interval  = os.getenv('WATCH_POLL_INTERVAL', sync_interval)
+sync_interval_hint   = os.getenv('SYNC_INTERVAL_HINT', 0)
 server_api_port      = os.getenv('API_PORT')
 server_api_protocol  = os.getenv('API_PROTOCOL', 'http')
+api_timeout          = os.getenv('API_TIMEOUT', 30)
+api_retries          = os.getenv('API_RETRIES', 3)
 shares_path          = os.getenv('SHARES_PATH', '/shares')
 server_ui_username   = os.getenv('SERVER_UI_USERNAME', 'admin')
 server_ui_password   = os.getenv('SERVER_UI_PASSWORD')
 server_debug         = os.getenv('SERVER_DEBUG', False)
+files_accel_redirect = os.getenv('FILES_ACCEL_REDIRECT', True)
+sync_write_mode      = os.getenv('SYNC_WRITE_MODE', 'direct')
+async_api            = os.getenv('ASYNC_API', False)
 unison_params        = os.getenv('UNISON_PARAMS', '#place additional params with UNISON_PARAMS env')